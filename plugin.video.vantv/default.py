@@ -1,32 +1,38 @@
+import threading
 import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import sha1
 from json import dumps, loads
 from sys import argv
-from time import time
+from time import perf_counter, time
 from traceback import format_exc
+from typing import Callable
 
-import inputstreamhelper
-import iptv_wizard
 import xbmc
 import xbmcaddon
 import xbmcgui
 import xbmcplugin
-from licproxy_service import main_service
-from requests import HTTPError, Session
-from resources.lib.myvodka import login as myvodka_login
-from resources.lib.myvodka import static as myvodka_static
-from resources.lib.myvodka import vtv
+from requests import HTTPError, RequestException, Session
 from resources.lib.utils import (
+    get_jwt_expiry,
     get_kodi_version,
+    get_profile_path,
     is_android,
+    licproxy,
+    preconnect,
     prepare_device,
     prepare_session,
     zulu_to_human_localtime,
 )
+from resources.lib.utils.cache import ResponseCache
+from resources.lib.utils.http import create_session
+from resources.lib.utils.lease import FileLease
+from resources.lib.utils.ledger import SessionLedger, get_session_ledger
 from resources.lib.van import (
+    catalogue,
     devices,
     enums,
     login,
-    media_list,
     playback,
     recording,
     static,
@@ -35,6 +41,14 @@ from xbmcvfs import translatePath
 
 addon = xbmcaddon.Addon()
 
+CATALOGUE_REFRESH_PROPERTY = "kodi.van.catalogue_refresh"
+# how many times to retry a session setup that failed with 1007
+SESSION_SETUP_RETRIES = 3
+# content tokens are cached this long if we can't tell their expiry
+CONTENT_TOKEN_TTL = 300
+# cached content tokens this close to their expiry are not used anymore
+CONTENT_TOKEN_MARGIN = 60
+
 
 def add_item(plugin_prefix, handle, name, action, is_directory, **kwargs) -> None:
     """
@@ -137,13 +151,75 @@ def add_item(plugin_prefix, handle, name, action, is_directory, **kwargs) -> Non
     xbmcplugin.addDirectoryItem(int(handle), url, item, is_directory)
 
 
-def authenticate(session: Session, addon_from_thread: xbmcaddon.Addon = None) -> None:
+def _is_access_token_valid(addon_local: xbmcaddon.Addon) -> bool:
+    """
+    Helper, that checks if we have an access token that's not expired yet.
+
+    :param addon_local: The addon object to read the settings from.
+    :return: True if the access token can be used.
+    """
+    access_token_expiry = addon_local.getSetting("accessexpiry")
+    return bool(access_token_expiry) and int(access_token_expiry) >= int(time())
+
+
+def authenticate(
+    session: Session,
+    addon_from_thread: xbmcaddon.Addon = None,
+    force_refresh: bool = False,
+    interactive: bool = True,
+) -> None:
     """
     Should be called before any API requests are made.
     Handles the login process and token refreshing. If reauthentication is necessary,
      this function will handle it.
 
+    Logins are single-flight across processes: only the holder of the auth lease
+     talks to the API, the others wait for it and reuse the new token.
+
+    :param session: The requests session to use.
+    :param force_refresh: Refresh the access token even if it's still valid.
+    :param interactive: Show dialogs and exit on fatal errors. Background callers
+     should disable it, the errors are raised instead.
+    :return: None
+    :raises HTTPError: If the login fails and interactive is disabled.
+    :raises ValueError: If the login response is invalid.
+    """
+    addon_local = addon_from_thread or addon
+
+    if not all(
+        [addon_local.getSetting("username"), addon_local.getSetting("password")]
+    ):
+        return
+    if not force_refresh and _is_access_token_valid(addon_local):
+        return
+    access_token_issued = addon_local.getSetting("accessissued")
+    with FileLease(get_profile_path("auth.lock")) as acquired:
+        if not acquired:
+            xbmc.log(
+                f"[{addon_local.getAddonInfo('name')}] Auth lease timed out, logging in anyway",
+                xbmc.LOGWARNING,
+            )
+        # NOTE: someone else might have refreshed the token while we were waiting
+        if force_refresh:
+            if addon_local.getSetting("accessissued") != access_token_issued:
+                return
+        elif _is_access_token_valid(addon_local):
+            return
+        _authenticate(session, addon_from_thread, force_refresh, interactive)
+
+
+def _authenticate(
+    session: Session,
+    addon_from_thread: xbmcaddon.Addon = None,
+    force_refresh: bool = False,
+    interactive: bool = True,
+) -> None:
+    """
+    Helper, that does the actual login or token refresh, see authenticate.
+
     :param session: The requests session to use.
+    :param force_refresh: Refresh the access token even if it's still valid.
+    :param interactive: Show dialogs and exit on fatal errors instead of raising.
     :return: None
     """
     addon_local = addon_from_thread or addon
@@ -181,7 +257,11 @@ def authenticate(session: Session, addon_from_thread: xbmcaddon.Addon = None) ->
                 ):
                     addon_local.setSetting("devicekey", "")
                     addon_local.setSetting("accessexpiry", "")
-                    return authenticate(session, addon_from_thread)
+                    return _authenticate(
+                        session, addon_from_thread, interactive=interactive
+                    )
+                if not interactive:
+                    raise
 
                 dialog = xbmcgui.Dialog()
                 dialog.ok(
@@ -195,6 +275,8 @@ def authenticate(session: Session, addon_from_thread: xbmcaddon.Addon = None) ->
                 exit()
             # if we get an error code here, the login is most-likely invalid
             # so we show a dialog and open the settings
+            if not interactive:
+                raise
             message = ""
             if "application/json" in e.response.headers.get("Content-Type", ""):
                 message = e.response.json().get("message")
@@ -207,8 +289,8 @@ def authenticate(session: Session, addon_from_thread: xbmcaddon.Addon = None) ->
             )
             addon_local.openSettings()
             exit()
-        _parse_login_response(login_response)
-    elif int(access_token_expiry) < int(time()):
+        _parse_login_response(login_response, addon_from_thread, interactive)
+    elif force_refresh or int(access_token_expiry) < int(time()):
         # try to refresh the token if refresh token is still valid
         refresh_token_expiry = addon_local.getSetting("refreshexpiry")
         if int(refresh_token_expiry) > int(time()):
@@ -221,30 +303,37 @@ def authenticate(session: Session, addon_from_thread: xbmcaddon.Addon = None) ->
             except HTTPError as e:
                 # refresh token probably invalid, redo the whole login process
                 addon_local.setSetting("accessexpiry", "")
-                return authenticate(session, addon_from_thread)
-            _parse_login_response(refresh_response, addon_from_thread)
+                return _authenticate(
+                    session, addon_from_thread, interactive=interactive
+                )
+            _parse_login_response(refresh_response, addon_from_thread, interactive)
         else:
             # refresh token invalid, redo the whole login process
             addon_local.setSetting("accessexpiry", "")
-            return authenticate(session, addon_from_thread)
+            return _authenticate(session, addon_from_thread, interactive=interactive)
 
 
 def _parse_login_response(
-    response: dict, addon_from_thread: xbmcaddon.Addon = None
+    response: dict, addon_from_thread: xbmcaddon.Addon = None, interactive: bool = True
 ) -> None:
     """
     Helper, that parses the login response and sets the necessary settings.
 
     :param response: The login response.
+    :param interactive: Show a dialog and open the settings on invalid responses.
     :return: None
+    :raises ValueError: If the response doesn't contain the tokens.
     """
     addon_local = addon_from_thread or addon
 
     access_token = response.get("access_token")
-    access_token_expiry = response.get("expires_in", 0) + int(time())
+    access_token_issued = int(time())
+    access_token_expiry = response.get("expires_in", 0) + access_token_issued
     refresh_token = response.get("refresh_token")
     refresh_token_expiry = response.get("refresh_expires_in", 0) + int(time())
     if not all([access_token, refresh_token]):
+        if not interactive:
+            raise ValueError("Missing tokens from login response")
         # if we don't get the necessary tokens, show a dialog and open the settings
         dialog = xbmcgui.Dialog()
         dialog.ok(
@@ -257,6 +346,8 @@ def _parse_login_response(
         raise ValueError("Missing tokens from login response")
     addon_local.setSetting("accesstoken", access_token)
     addon_local.setSetting("accessexpiry", str(access_token_expiry))
+    # used by the background token keeper to calculate the lifetime of the token
+    addon_local.setSetting("accessissued", str(access_token_issued))
     addon_local.setSetting("refreshtoken", refresh_token)
     addon_local.setSetting("refreshexpiry", str(refresh_token_expiry))
     device_key = response.get("client_id")
@@ -306,6 +397,14 @@ def main_menu() -> None:
         description=addon.getLocalizedString(30106),
         is_directory=True,
     )
+    # request timings
+    add_item(
+        plugin_prefix=argv[0],
+        handle=argv[1],
+        name=addon.getLocalizedString(30121),
+        action="perf_stats",
+        is_directory=True,
+    )
     # addon settings
     add_item(
         plugin_prefix=argv[0],
@@ -326,19 +425,49 @@ def main_menu() -> None:
     xbmcplugin.endOfDirectory(int(argv[1]))
 
 
-def get_user_entitlements(session: Session) -> list:
+def get_response_cache() -> ResponseCache:
     """
-    Get the list of products the current user is entitled to.
-    Also filters out the products that are not subscribed.
+    Get the persistent response cache shared by the plugin and the service.
+
+    :return: The response cache.
+    """
+    return ResponseCache(get_profile_path("cache"))
+
+
+def request_catalogue_refresh(key: str) -> None:
+    """
+    Asks the service to revalidate the cached catalogue in the background.
+    Called when expired catalogue data was served from the persistent cache.
+
+    :param key: The key of the expired cache entry.
+    :return: None
+    """
+    xbmc.log(f"Serving stale {key}, requesting background refresh", xbmc.LOGDEBUG)
+    xbmcgui.Window(static.HOME_ID).setProperty(CATALOGUE_REFRESH_PROPERTY, "true")
+
+
+def get_channel_catalogue(session: Session, refresh: bool = False) -> list:
+    """
+    Get the list of channels the current user is entitled to.
+    Shared by the channel list and the exports, see the catalogue module.
+    Served from the persistent cache if possible, even if expired. Expired data
+     is then refreshed in the background by the service.
 
     :param session: The requests session.
+    :param refresh: Whether to bypass the caches and fetch from the provider.
 
-    :return: The list of subscribed products.
+    :return: The list of catalogue.Channel records.
     """
     try:
-        entitlements = media_list.get_entitlements(
-            session, static.get_api_base(), addon.getSetting("accesstoken")
-        ).get("resourceSet", [])
+        return catalogue.get_catalogue(
+            session,
+            static.get_api_base(),
+            addon.getSetting("accesstoken"),
+            cache=get_response_cache(),
+            scope=addon.getSetting("username"),
+            on_stale=request_catalogue_refresh,
+            refresh=refresh,
+        )
     except HTTPError as e:
         xbmc.log(format_exc(), xbmc.LOGERROR)
         dialog = xbmcgui.Dialog()
@@ -349,12 +478,6 @@ def get_user_entitlements(session: Session) -> list:
             ),
         )
         exit()
-    # filter for subscribed products
-    return [
-        entitlement["productId"]
-        for entitlement in entitlements
-        if entitlement.get("productId") and entitlement.get("status") == "SUBSCRIBED"
-    ]
 
 
 def channel_list(session: Session) -> None:
@@ -365,58 +488,36 @@ def channel_list(session: Session) -> None:
     :param session: The requests session.
     :return: None
     """
-    entitlements = get_user_entitlements(session)
-
-    service_list = media_list.get_channel_list(
-        session, static.get_api_base(), addon.getSetting("accesstoken")
-    ).get("services", [])
-    for service in service_list:
-        editorial = service.get("editorial", {})
-        technical = service.get("technical", {})
-
-        drm_id = technical.get("drmId")
-        channel_url = technical.get("NetworkLocation")
-        if not drm_id or not channel_url:
+    # NOTE: through the broker this warms up the connection of the service,
+    # so the playback started from this list doesn't wait for the handshake
+    preconnect(session, [static.get_license_server_base()])
+    for channel in get_channel_catalogue(session):
+        if not channel.drm_id or not channel.url:
             # without a DRM ID or URL we can't play the stream
             continue
 
-        name = editorial.get("longName", addon.getLocalizedString(30056))
-
-        product_refs = technical.get("productRefs") or []
-        if not any([product_ref in entitlements for product_ref in product_refs]):
-            # user is not entitled to this channel
-            xbmc.log(
-                f"Skipping channel {name}, user not entitled",
-                xbmc.LOGDEBUG,
-            )
-            continue
+        name = channel.name or addon.getLocalizedString(30056)
 
-        genres = editorial.get("Categories", [])
-        # get first rating code from the list
-        ratings = editorial.get("Ratings", [])
-        rating = ratings[0].get("code") if ratings else None
+        rating = channel.rating
         # if rating == "hu-unrated":
         #    rating = None
         if rating == "hu-12":
             rating = "TV-14"
         # NOTE: so far no other ratings were found
 
-        channel_id = editorial.get("id")
         icon = None
-        if channel_id:
-            # NOTE: standard requests use much smaller 16:9 images
-            # those look ugly within Kodi, so we use a higher resolution 1:1 image
-            icon = f"{static.get_imageservice_base()}/images/v1/image/channel/{channel_id}/logo?aspect=1x1&height=256&imageFormat=webp&width=256"
+        if channel.id:
+            icon = channel.logo(static.get_imageservice_base())
         add_item(
             plugin_prefix=argv[0],
             handle=argv[1],
             name=name,
-            id=drm_id,
+            id=channel.drm_id,
             action="play_channel",
             is_directory=False,
             icon=icon,
-            extra=urllib.parse.quote_plus(channel_url),
-            genres=genres,
+            extra=urllib.parse.quote_plus(channel.url),
+            genres=list(channel.genres),
             mpaa=rating,
         )
 
@@ -424,21 +525,131 @@ def channel_list(session: Session) -> None:
     xbmcplugin.setContent(int(argv[1]), "videos")
 
 
-def play(session: Session, channel_id: str, channel_url: str) -> None:
+def _timed(timings: dict, name: str, func: Callable, *args, **kwargs):
     """
-    Plays the selected channel, sets up the session, prepares the inputstream,
-     creates a license proxy thread and starts the playback. Then keeps monitoring
-     the playback until it's stopped.
+    Helper, that calls a function and records how long it took.
 
-    :param session: The requests session.
-    :param channel_id: The ID of the channel.
-    :param channel_url: The URL of the channel.
+    :param timings: Phase name to duration in milliseconds, updated in place.
+    :param name: The name of the phase.
+    :param func: The function to call.
+    :return: The return value of the function.
+    """
+    start = perf_counter()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        timings[name] = int((perf_counter() - start) * 1000)
+
+
+def _check_inputstream() -> tuple:
+    """
+    Helper, that prepares inputstreamhelper and checks if ISA is ready for Widevine.
+
+    :return: Tuple of the helper and the result of the check.
+    """
+    import inputstreamhelper
+
+    is_helper = inputstreamhelper.Helper("mpd", drm="com.widevine.alpha")
+    return is_helper, is_helper.check_inputstream()
+
+
+def _prefetch_manifest(session: Session, url: str) -> None:
+    """
+    Helper, that downloads the manifest once, so the connection to the CDN
+     is already warm when ISA requests it. Errors are ignored.
+
+    :param session: The requests session to use.
+    :param url: The URL of the manifest.
     :return: None
     """
     try:
-        content_token_response = playback.get_content_token(
-            session, static.get_api_base(), addon.getSetting("accesstoken"), channel_id
+        session.get(
+            url, headers={"User-Agent": addon.getSetting("useragent")}, timeout=5
+        ).close()
+    except Exception:
+        xbmc.log(f"Manifest pre-fetch failed: {format_exc()}", xbmc.LOGDEBUG)
+
+
+def teardown_orphaned_sessions(session: Session, ledger: SessionLedger) -> None:
+    """
+    Tears down the DRM sessions left behind by crashed plugin processes,
+     so they don't occupy a slot of the concurrent session limit.
+
+    :param session: The requests session to use.
+    :param ledger: The session ledger.
+    :return: None
+    """
+    teardown_url = f"{static.get_license_server_base()}/ssm/v1/sessions/teardown"
+    for key, session_token in ledger.take_orphans():
+        try:
+            # a rejected call means the provider doesn't know the session anymore
+            playback.teardown_session(session, teardown_url, session_token)
+        except RequestException:
+            # try again next time
+            xbmc.log(f"Orphan teardown failed: {format_exc()}", xbmc.LOGERROR)
+            continue
+        ledger.mark_ended(key)
+        xbmc.log(f"Orphaned DRM session torn down: {key}", xbmc.LOGINFO)
+
+
+def _content_token_key(drm_id: str) -> str:
+    """
+    Helper, that builds the cache key of a content token. Contains the fingerprint
+     of the access token, so tokens of another login are never reused.
+
+    :param drm_id: The DRM ID of the content.
+    :return: The cache key.
+    """
+    fingerprint = sha1(addon.getSetting("accesstoken").encode("utf-8")).hexdigest()
+    return f"content_token:{fingerprint[:16]}:{drm_id}"
+
+
+def get_cached_content_token(cache: ResponseCache, drm_id: str) -> str:
+    """
+    Get a content token from the persistent cache, if it's still valid for a while.
+
+    :param cache: The persistent cache.
+    :param drm_id: The DRM ID of the content.
+    :return: The content token or None.
+    """
+    value, _ = cache.get(_content_token_key(drm_id))
+    if value and value.get("expires", 0) - CONTENT_TOKEN_MARGIN > time():
+        return value.get("token")
+
+
+def fetch_content_token(session: Session, cache: ResponseCache, drm_id: str) -> str:
+    """
+    Requests a new content token and stores it in the persistent cache,
+     until the expiry in the token or CONTENT_TOKEN_TTL if it has none.
+
+    :param session: The requests session.
+    :param cache: The persistent cache.
+    :param drm_id: The DRM ID of the content.
+    :return: The content token or None if the response had none.
+    """
+    content_token = playback.get_content_token(
+        session, static.get_api_base(), addon.getSetting("accesstoken"), drm_id
+    ).get("content_token")
+    if content_token:
+        expires = get_jwt_expiry(content_token) or int(time()) + CONTENT_TOKEN_TTL
+        cache.set(
+            _content_token_key(drm_id), {"token": content_token, "expires": expires}
         )
+    return content_token
+
+
+def _request_content_token(session: Session, cache: ResponseCache, drm_id: str) -> str:
+    """
+    Helper, that fetches a new content token for play(). Shows a dialog
+     and exits on failure.
+
+    :param session: The requests session.
+    :param cache: The persistent cache.
+    :param drm_id: The DRM ID of the content.
+    :return: The content token.
+    """
+    try:
+        content_token = fetch_content_token(session, cache, drm_id)
     except HTTPError as e:
         xbmc.log(format_exc(), xbmc.LOGERROR)
         # show error dialog and exit
@@ -450,59 +661,265 @@ def play(session: Session, channel_id: str, channel_url: str) -> None:
             ),
         )
         exit()
-    content_token = content_token_response.get("content_token")
     if not content_token:
         # show error dialog and exit
         dialog = xbmcgui.Dialog()
         dialog.ok(addon.getAddonInfo("name"), addon.getLocalizedString(30020))
         exit()
+    return content_token
+
 
+def prefetch_adjacent_content_tokens(
+    session: Session, cache: ResponseCache, drm_id: str
+) -> None:
+    """
+    Fetches the content tokens of the previous and the next channel in the
+     channel list order, so zapping to them can skip that request.
+    Meant to run in the background, errors are only logged.
+
+    :param session: The requests session.
+    :param cache: The persistent cache.
+    :param drm_id: The DRM ID of the channel being watched.
+    :return: None
+    """
     try:
-        session_setup_response = playback.setup_session(
-            session, static.get_license_server_base(), content_token
-        )
-    except HTTPError as e:
-        # NOTE: consider adding more errors from:
-        # https://docs.nagra.com/connect-player-sdk-5-for-android-docs/5.36.x/Default/ssm-error-codes
-        # (the provider only has a few of these implemented)
-        if (
-            e.response.status_code == 400
-            and "application/json" in e.response.headers.get("Content-Type", "")
-            and e.response.json().get("errorCode") == 1007
-        ):
-            # Maximum sessions limit reached
-            dialog = xbmcgui.Dialog()
-            dialog.ok(
-                addon.getAddonInfo("name"),
-                addon.getLocalizedString(30026),
+        channels = [
+            channel.drm_id
+            for channel in catalogue.get_catalogue(
+                session,
+                static.get_api_base(),
+                addon.getSetting("accesstoken"),
+                cache=cache,
+                scope=addon.getSetting("username"),
             )
-            exit()
-        xbmc.log(format_exc(), xbmc.LOGERROR)
-        # show error dialog and exit
+            if channel.drm_id and channel.url
+        ]
+        if drm_id not in channels:
+            # not a live channel (e.g. a recording)
+            return
+        index = channels.index(drm_id)
+        for adjacent in {
+            channels[index - 1],
+            channels[(index + 1) % len(channels)],
+        } - {drm_id}:
+            if not get_cached_content_token(cache, adjacent):
+                fetch_content_token(session, cache, adjacent)
+    except Exception:
+        xbmc.log(f"Content token pre-fetch failed: {format_exc()}", xbmc.LOGERROR)
+
+
+class PlaybackMonitor(xbmc.Player):
+    """
+    Player that follows a single playback and calls on_stop as soon as it ends,
+     so the DRM session is torn down right away instead of on the next poll.
+
+    The callbacks are delivered to every player instance and the monitor is
+     created before the playback starts, so the end of the previous stream
+     (e.g. while zapping) would look like ours. End events only count after our
+     stream has started, playbacks that never start are left to the start timeout.
+    """
+
+    def __init__(self, channel_url: str, on_stop: Callable) -> None:
+        super().__init__()
+        self.channel_url = channel_url
+        self.on_stop = on_stop
+        self.started = threading.Event()
+        self.ended = threading.Event()
+
+    def _end(self) -> None:
+        if not self.started.is_set() or self.ended.is_set():
+            return
+        self.ended.set()
+        self.on_stop()
+
+    def _check_file(self) -> None:
+        # when a user switches to another stream without stopping the previous one
+        # Kodi will only trigger onPlayBackResumed, so we need to check if the url is the same
+        try:
+            playing_file = self.getPlayingFile()
+        except RuntimeError:
+            # nothing is playing anymore
+            return self._end()
+        if playing_file == self.channel_url:
+            self.started.set()
+        elif self.started.is_set():
+            self._end()
+
+    def onAVStarted(self) -> None:
+        self._check_file()
+
+    def onAVChange(self) -> None:
+        self._check_file()
+
+    def onPlayBackResumed(self) -> None:
+        self._check_file()
+
+    def onPlayBackStopped(self) -> None:
+        self._end()
+
+    def onPlayBackEnded(self) -> None:
+        self._end()
+
+    def onPlayBackError(self) -> None:
+        self._end()
+
+    def wait(
+        self,
+        monitor: xbmc.Monitor,
+        start_timeout: int = 120,
+        heartbeat: Callable = None,
+        heartbeat_interval: int = 30,
+    ) -> None:
+        """
+        Blocks until the playback ends. Kodi dispatches the player callbacks
+         while we are waiting for abort, so the loop itself does no work
+         apart from the optional heartbeat.
+
+        :param monitor: The monitor to wait on.
+        :param start_timeout: Seconds to wait for the playback to start.
+        :param heartbeat: Called every heartbeat_interval seconds while waiting.
+        :param heartbeat_interval: Seconds between heartbeats.
+        :return: None
+        """
+        elapsed = 0
+        while not self.ended.is_set():
+            if not self.started.is_set() and elapsed >= start_timeout:
+                return
+            if monitor.waitForAbort(1):
+                return
+            elapsed += 1
+            if heartbeat and elapsed % heartbeat_interval == 0:
+                heartbeat()
+
+
+def play(session: Session, channel_id: str, channel_url: str) -> None:
+    """
+    Plays the selected channel, sets up the session, prepares the inputstream,
+     creates a license proxy thread and starts the playback. Then keeps monitoring
+     the playback until it's stopped.
+
+    :param session: The requests session.
+    :param channel_id: The ID of the channel.
+    :param channel_url: The URL of the channel.
+    :return: None
+    """
+    start = perf_counter()
+    timings = {}
+
+    if addon.getSettingBool("httpmanifest"):
+        # force the use of HTTP for the manifest
+        # this is a workaround for the issue where Kodi doesn't trust the provider's cert
+        # not recommended
+        channel_url = (
+            urllib.parse.urlparse(channel_url)._replace(scheme="http").geturl()
+        )
+
+    # the license host is only needed after the content token, connect to it meanwhile
+    preconnect(session, [static.get_license_server_base(), channel_url])
+
+    # NOTE: only the content token and the session setup depend on each other,
+    # the ISA check and the manifest pre-fetch run alongside the content token
+    # request and the orphan cleanup
+    executor = ThreadPoolExecutor(max_workers=2)
+    isa_future = executor.submit(_timed, timings, "isa_check", _check_inputstream)
+    if addon.getSettingBool("prefetchmanifest"):
+        executor.submit(
+            _timed, timings, "manifest", _prefetch_manifest, session, channel_url
+        )
+    executor.shutdown(wait=False)
+
+    cache = get_response_cache()
+    content_token = get_cached_content_token(cache, channel_id)
+    content_token_cached = bool(content_token)
+    if not content_token:
+        content_token = _timed(
+            timings,
+            "content_token",
+            _request_content_token,
+            session,
+            cache,
+            channel_id,
+        )
+
+    ledger = get_session_ledger()
+    _timed(timings, "orphans", teardown_orphaned_sessions, session, ledger)
+
+    # NOTE: wait for the ISA check before the DRM session is set up, exiting
+    # after the setup would leave the session occupying a slot
+    is_helper, is_ready = isa_future.result()
+    if not is_ready:
         dialog = xbmcgui.Dialog()
         dialog.ok(
             addon.getAddonInfo("name"),
-            addon.getLocalizedString(30019).format(
-                status=e.response.status_code, body=e.response.text
-            ),
+            addon.getLocalizedString(30021),
         )
         exit()
+
+    retries = 0
+    while True:
+        try:
+            session_setup_response = _timed(
+                timings,
+                "session_setup",
+                playback.setup_session,
+                session,
+                static.get_license_server_base(),
+                content_token,
+            )
+            break
+        except HTTPError as e:
+            # NOTE: consider adding more errors from:
+            # https://docs.nagra.com/connect-player-sdk-5-for-android-docs/5.36.x/Default/ssm-error-codes
+            # (the provider only has a few of these implemented)
+            session_limit_reached = (
+                e.response.status_code == 400
+                and "application/json" in e.response.headers.get("Content-Type", "")
+                and e.response.json().get("errorCode") == 1007
+            )
+            if content_token_cached and not session_limit_reached:
+                # the cached content token might have been revoked, retry with a fresh one
+                content_token_cached = False
+                cache.delete(_content_token_key(channel_id))
+                content_token = _request_content_token(session, cache, channel_id)
+                continue
+            if session_limit_reached:
+                # Maximum sessions limit reached
+                # if one of our own sessions is still ending (e.g. while zapping),
+                # the slot frees up shortly, so it's worth waiting a bit
+                if retries < SESSION_SETUP_RETRIES and ledger.has_recent():
+                    retries += 1
+                    xbmc.log(
+                        f"Session limit reached, retrying setup ({retries})",
+                        xbmc.LOGINFO,
+                    )
+                    if xbmc.Monitor().waitForAbort(2 * retries):
+                        exit()
+                    teardown_orphaned_sessions(session, ledger)
+                    continue
+                dialog = xbmcgui.Dialog()
+                dialog.ok(
+                    addon.getAddonInfo("name"),
+                    addon.getLocalizedString(30026),
+                )
+                exit()
+            xbmc.log(format_exc(), xbmc.LOGERROR)
+            # show error dialog and exit
+            dialog = xbmcgui.Dialog()
+            dialog.ok(
+                addon.getAddonInfo("name"),
+                addon.getLocalizedString(30019).format(
+                    status=e.response.status_code, body=e.response.text
+                ),
+            )
+            exit()
     session_token = session_setup_response.get("sessionToken")
     if not session_token:
         # show error dialog and exit
         dialog = xbmcgui.Dialog()
         dialog.ok(addon.getAddonInfo("name"), addon.getLocalizedString(30020))
         exit()
-
-    if addon.getSettingBool("httpmanifest"):
-        # force the use of HTTP for the manifest
-        # this is a workaround for the issue where Kodi doesn't trust the provider's cert
-        # not recommended
-        channel_url = (
-            urllib.parse.urlparse(channel_url)._replace(scheme="http").geturl()
-        )
-
-    is_helper = inputstreamhelper.Helper("mpd", drm="com.widevine.alpha")
+    # record the session, so it can be torn down even if we crash
+    ledger.add(session_token)
 
     license_url = (
         f"{static.get_license_server_base()}/wvls/contentlicenseservice/v1/licenses"
@@ -510,9 +927,29 @@ def play(session: Session, channel_id: str, channel_url: str) -> None:
     renewal_url = f"{static.get_license_server_base()}/ssm/v1/renewal-license-wv"
     teardown_url = f"{static.get_license_server_base()}/ssm/v1/sessions/teardown"
 
-    licproxy_thread = main_service(
-        addon, license_url, renewal_url, session_token, teardown_url
+    licproxy_thread = _timed(
+        timings,
+        "license_proxy",
+        licproxy.register_session,
+        license_url,
+        renewal_url,
+        session_token,
+        teardown_url,
     )
+    if not licproxy_thread:
+        # the service is not running, start a proxy just for this playback
+        from licproxy_service import main_service
+
+        licproxy_thread = _timed(
+            timings,
+            "license_proxy",
+            main_service,
+            addon,
+            license_url,
+            renewal_url,
+            session_token,
+            teardown_url,
+        )
 
     play_item = xbmcgui.ListItem(path=channel_url)
 
@@ -553,14 +990,6 @@ def play(session: Session, channel_id: str, channel_url: str) -> None:
                 "inputstream.adaptive.stream_headers",
                 stream_headers,
             )
-    if not is_helper.check_inputstream():
-        dialog = xbmcgui.Dialog()
-        dialog.ok(
-            addon.getAddonInfo("name"),
-            addon.getLocalizedString(30021),
-        )
-        exit()
-
     if not is_android():
         user_agent = addon.getSetting("useragent")
     else:
@@ -575,27 +1004,31 @@ def play(session: Session, channel_id: str, channel_url: str) -> None:
         }
     )
 
-    license_url = f'http://127.0.0.1:{licproxy_thread.port}/wv/license|{license_headers}|{{"challenge":"b{{SSM}}"}}|JBlicense'
+    license_url = f'http://127.0.0.1:{licproxy_thread.port}{licproxy_thread.license_path}|{license_headers}|{{"challenge":"b{{SSM}}"}}|JBlicense'
     play_item.setProperty("inputstream.adaptive.license_key", license_url)
 
-    xbmcplugin.setResolvedUrl(int(argv[1]), True, listitem=play_item)
+    def stop_licproxy() -> None:
+        if licproxy_thread and licproxy_thread.is_alive():
+            licproxy_thread.stop()
 
-    monitor = xbmc.Monitor()
-    player = xbmc.Player()
+    # NOTE: must exist before the playback starts, otherwise we miss its events
+    player = PlaybackMonitor(channel_url, stop_licproxy)
 
-    timeout = 120
-    while not player.isPlaying() and not monitor.waitForAbort(1) and timeout > 0:
-        timeout -= 1
+    xbmcplugin.setResolvedUrl(int(argv[1]), True, listitem=play_item)
+    if addon.getSettingBool("prefetchtokens"):
+        threading.Thread(
+            target=prefetch_adjacent_content_tokens,
+            args=(session, cache, channel_id),
+        ).start()
+    xbmc.log(
+        f"[{addon.getAddonInfo('name')}] Playback startup took {int((perf_counter() - start) * 1000)} ms, phases (ms): {timings}",
+        xbmc.LOGINFO,
+    )
 
-    while player.isPlaying() and not monitor.waitForAbort(1):
-        # when a user switches to another stream without stopping the previous one
-        # Kodi will only trigger onPlayBackResumed, so we need to check if the url is the same
-        # if they are different, stop the licproxy thread
-        if player.isPlaying() and channel_url != player.getPlayingFile():
-            break
+    player.wait(xbmc.Monitor(), heartbeat=lambda: ledger.touch(session_token))
 
-    if licproxy_thread and licproxy_thread.is_alive():
-        licproxy_thread.stop()
+    if licproxy_thread:
+        stop_licproxy()
         try:
             licproxy_thread.join()
         except RuntimeError:
@@ -853,15 +1286,14 @@ def prepare_myvodka_session() -> Session:
 
     :return: requests session
     """
-    session = Session()
-    session.headers.update(
+    return create_session(
         {
             "Accept-Encoding": "gzip",
             "User-Agent": "okhttp/4.11.0",
             "Connection": "Keep-Alive",
-        }
+        },
+        addon,
     )
-    return session
 
 
 def vodka_authenticate() -> None:
@@ -870,6 +1302,9 @@ def vodka_authenticate() -> None:
 
     :return: None
     """
+    from resources.lib.myvodka import login as myvodka_login
+    from resources.lib.myvodka import static as myvodka_static
+
     session = prepare_myvodka_session()
 
     # check if we have a token and if it's still valid
@@ -969,6 +1404,9 @@ def vodka_device_list() -> None:
     :param session: requests session
     :return: None
     """
+    from resources.lib.myvodka import static as myvodka_static
+    from resources.lib.myvodka import vtv
+
     vodka_authenticate()
     session = prepare_myvodka_session()
 
@@ -1040,6 +1478,9 @@ def rename_vodka_device(device: str) -> None:
     :param device_id: device id (udid)
     :return: None
     """
+    from resources.lib.myvodka import static as myvodka_static
+    from resources.lib.myvodka import vtv
+
     # prompt for new name
     dialog = xbmcgui.Dialog()
     device_data = loads(device)
@@ -1087,6 +1528,9 @@ def delete_vodka_device(device: str) -> None:
     :param device_id: device id (udid)
     :return: None
     """
+    from resources.lib.myvodka import static as myvodka_static
+    from resources.lib.myvodka import vtv
+
     vodka_authenticate()
     session = prepare_myvodka_session()
     access_token = xbmcgui.Window(static.HOME_ID).getProperty(
@@ -1288,6 +1732,67 @@ def catchup(
             dialog.ok(addon.getAddonInfo("name"), addon.getLocalizedString(30092))
 
 
+def perf_stats() -> None:
+    """
+    Renders the latency and error rate of the provider endpoints,
+     the slowest ones first.
+
+    :return: None
+    """
+    from resources.lib.utils.perfstats import get_perf_stats
+
+    summary = get_perf_stats().summarize()
+    if not summary:
+        dialog = xbmcgui.Dialog()
+        dialog.ok(addon.getAddonInfo("name"), addon.getLocalizedString(30122))
+        return
+
+    ctx_menu = [
+        (
+            addon.getLocalizedString(30126),
+            f"RunPlugin({argv[0]}?action=clear_perf_stats)",
+        )
+    ]
+    for endpoint, stats in sorted(
+        summary.items(), key=lambda item: item[1]["p95"], reverse=True
+    ):
+        description = (
+            f"{addon.getLocalizedString(30123)}: {stats['count']}\n"
+            f"p50: {stats['p50'] * 1000:.0f} ms\n"
+            f"p95: {stats['p95'] * 1000:.0f} ms\n"
+            f"{addon.getLocalizedString(30124)}: {stats['error_rate']:.1%}\n"
+        )
+        if stats["bytes"]:
+            description += (
+                f"{addon.getLocalizedString(30125)}: {stats['bytes'] / 1024:.1f} KiB\n"
+            )
+        add_item(
+            plugin_prefix=argv[0],
+            handle=argv[1],
+            name=f"{endpoint} [{stats['p50'] * 1000:.0f} / {stats['p95'] * 1000:.0f} ms]",
+            description=description,
+            action="show_cm",
+            is_directory=True,
+            ctx_menu=ctx_menu,
+            refresh=True,
+        )
+
+    xbmcplugin.endOfDirectory(int(argv[1]))
+    xbmcplugin.setContent(int(argv[1]), "files")
+
+
+def clear_perf_stats() -> None:
+    """
+    Removes the recorded request timings.
+
+    :return: None
+    """
+    from resources.lib.utils.perfstats import get_perf_stats
+
+    get_perf_stats().clear()
+    xbmc.executebuiltin("Container.Refresh")
+
+
 def about_dialog() -> None:
     """
     Show the about dialog.
@@ -1301,11 +1806,16 @@ def about_dialog() -> None:
     )
 
 
+# NOTE: every click starts a new interpreter, so heavy modules (inputstreamhelper,
+# the license proxy with bottle, MyVodka, the IPTV wizard, Cryptodome) are only
+# imported by the actions that actually need them
 if __name__ == "__main__":
     params = dict(urllib.parse.parse_qsl(argv[2].replace("?", "")))
     action = params.get("action")
     # session to be used for all requests
     session = prepare_session()
+    # send the provider requests through the service, if it's running
+    licproxy.mount_broker(session)
     # prepare the device model
     session.device_properties = prepare_device()
     # authenticate if necessary
@@ -1352,11 +1862,17 @@ if __name__ == "__main__":
         export_chanlist(session)
     elif action == "export_epg":
         export_epg(session)
+    elif action == "perf_stats":
+        perf_stats()
+    elif action == "clear_perf_stats":
+        clear_perf_stats()
     elif action == "addon_settings":
         addon.openSettings()
     elif action == "about":
         about_dialog()
     elif action == "iptv_wizard":
+        import iptv_wizard
+
         iptv_wizard.run(addon, session)
     elif action == "show_cm":
         xbmc.executebuiltin("Dialog.Close(all, true)")
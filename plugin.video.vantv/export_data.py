@@ -1,16 +1,36 @@
 import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
 from time import time
 from traceback import format_exc
+from typing import Iterator
 from urllib.parse import quote_plus, urlencode
 
 import xbmc
 import xbmcaddon
 import xbmcgui
 import xbmcvfs
-from default import authenticate, get_user_entitlements
+from default import (
+    CATALOGUE_REFRESH_PROPERTY,
+    authenticate,
+    get_channel_catalogue,
+    get_response_cache,
+    teardown_orphaned_sessions,
+)
+from licproxy_service import run_persistent_server
 from requests import HTTPError, Session
-from resources.lib.utils import prepare_device, prepare_session, unix_to_epg_time
-from resources.lib.van import media_list, static
+from resources.lib.utils import (
+    get_profile_path,
+    prepare_device,
+    prepare_session,
+    unix_to_epg_time,
+)
+from resources.lib.utils.epgcache import EPGCache
+from resources.lib.utils.ledger import get_session_ledger
+from resources.lib.utils.licproxy import PORT_PROPERTY
+from resources.lib.utils.writer import BufferedWriter
+from resources.lib.van import catalogue, media_list, static
 
 
 def get_path(addon: xbmcaddon.Addon, is_epg: bool = False) -> str:
@@ -23,6 +43,7 @@ def get_path(addon: xbmcaddon.Addon, is_epg: bool = False) -> str:
     """
     path = addon.getSetting("channelexportpath")
     if is_epg:
+        # NOTE: the name is kept with compression, IPTV Simple detects gzip by content
         name = addon.getSetting("epgexportname")
     else:
         name = addon.getSetting("channelexportname")
@@ -62,36 +83,12 @@ def export_channel_list(addon: xbmcaddon.Addon, session: Session) -> None:
         )
         return
 
-    entitlements = get_user_entitlements(session)
-
-    try:
-        service_list = media_list.get_channel_list(
-            session, static.get_api_base(), addon.getSetting("accesstoken")
-        )
-    except HTTPError as e:
-        xbmc.log(format_exc(), xbmc.LOGERROR)
-        # show error dialog and exit
-        dialog = xbmcgui.Dialog()
-        dialog.ok(
-            addon.getAddonInfo("name"),
-            addon.getLocalizedString(30019).format(
-                status=e.response.status_code, body=e.response.text
-            ),
-        )
-        exit()
-
     # m3u header
     output = "#EXTM3U\n\n"
 
-    for service in service_list.get("services") or []:
-        editorial = service.get("editorial", {})
-        technical = service.get("technical", {})
-
-        channel_id = editorial.get("id") or editorial.get("_id")
-        drm_id = technical.get("drmId")
-        channel_url = technical.get("NetworkLocation")
-        name = editorial.get("longName", addon.getLocalizedString(30056))
-        if not drm_id or not channel_url or not channel_id:
+    for channel in get_channel_catalogue(session):
+        name = channel.name or addon.getLocalizedString(30056)
+        if not channel.drm_id or not channel.url or not channel.id:
             # without a DRM ID or URL we can't play the stream
             # without a channel ID we can't uniquely identify the channel
             xbmc.log(
@@ -100,39 +97,27 @@ def export_channel_list(addon: xbmcaddon.Addon, session: Session) -> None:
             )
             continue
 
-        product_refs = technical.get("productRefs") or []
-        if not any([product_ref in entitlements for product_ref in product_refs]):
-            # user is not entitled to this channel
-            xbmc.log(
-                f"Skipping channel {name}, user not entitled",
-                xbmc.LOGDEBUG,
-            )
-            continue
-
         # all items are added to a meta group for easy filtering
         groups = [addon.getAddonInfo("name")]
 
-        genres = editorial.get("Categories") or []
-        for genre in genres:
+        for genre in channel.genres:
             groups.append(f"{genre.replace(';', ',')} ({addon.getAddonInfo('name')})")
 
-        # for some reason that's a string
-        is_adult = editorial.get("isAdult") or "" == "true"
-        if is_adult:
+        if channel.is_adult:
             groups.append(f"18+ ({addon.getAddonInfo('name')})")
 
         # multiple groups are supported by IPTV Simple since v3.2.1
         # https://github.com/kodi-pvr/pvr.iptvsimple/blob/a5f312c20643889c2f73334be36bba995280fa6d/pvr.iptvsimple/changelog.txt#L582
         groups = ";".join(groups)
 
-        icon = f"{static.get_imageservice_base()}/images/v1/image/channel/{channel_id}/logo?aspect=1x1&height=256&imageFormat=webp&width=256"
+        icon = channel.logo(static.get_imageservice_base())
 
         # m3u entry
-        output += f'#EXTINF:-1 tvg-id="{channel_id}" tvg-name="{name}" tvg-logo="{icon}" group-title="{groups}" catchup="vod",{name}\n'
+        output += f'#EXTINF:-1 tvg-id="{channel.id}" tvg-name="{name}" tvg-logo="{icon}" group-title="{groups}" catchup="vod",{name}\n'
         query = {
             "action": "play_channel",
-            "id": drm_id,
-            "extra": quote_plus(channel_url),
+            "id": channel.drm_id,
+            "extra": quote_plus(channel.url),
         }
         url = f"plugin://{addon.getAddonInfo('id')}/?{urlencode(query)}"
         output += f"{url}\n\n"
@@ -175,6 +160,263 @@ def enc_xml(text) -> str:
     return text.translate(translation_table)
 
 
+def _needs_refresh(
+    cache: EPGCache, channels: list, day: int, today: int, volatile_days: int
+) -> bool:
+    """
+    Decide whether a day bucket of a chunk of channels must be fetched from the provider.
+    New days, the current day and the volatile days after it are always fetched. Past
+     days are fetched one last time if they were cached before the day was over.
+    Empty past days are fetched again, the channel might have been missing from
+     the provider's response only temporarily.
+
+    :param cache: The EPG cache.
+    :param channels: The list of channel IDs in the chunk.
+    :param day: The day bucket.
+    :param today: The current day bucket.
+    :param volatile_days: The number of days after the current day to always fetch.
+
+    :return: True if the day needs to be fetched.
+    """
+    if today <= day <= today + volatile_days:
+        return True
+    for channel_id in channels:
+        stored_at = cache.stored_at(channel_id, day)
+        if not stored_at or (
+            day < today
+            and (stored_at < (day + 1) * 86400 or cache.is_empty(channel_id, day))
+        ):
+            return True
+    return False
+
+
+def _load_epg_window(
+    addon: xbmcaddon.Addon,
+    session: Session,
+    cache: EPGCache,
+    channels: list,
+    day: int,
+    refresh: bool,
+    is_killed: threading.Event = None,
+) -> dict:
+    """
+    Load one day of EPG data for a chunk of channels, either from the cache or from
+     the provider. Fresh data is written back to the cache. Runs on the EPG worker pool.
+
+    :param addon: The addon object.
+    :param session: The requests session to use.
+    :param cache: The EPG cache.
+    :param channels: The list of channel IDs to load.
+    :param day: The day bucket to load.
+    :param refresh: Whether to fetch the data from the provider.
+    :param is_killed: The threading.Event object to check if the export was cancelled.
+
+    :return: The EPG data in the provider's JSON format with lazily loaded results,
+     empty if the export was cancelled.
+    """
+    if is_killed and is_killed.is_set():
+        return {}
+    if refresh:
+        # results are streamed into the cache one channel at a time
+        stored = set()
+        # closing the iterator closes the response if the export is cancelled
+        with closing(
+            _fetch_epg_window(addon, session, channels, day * 86400, (day + 1) * 86400)
+        ) as results:
+            for channel_data in results:
+                if is_killed and is_killed.is_set():
+                    return {}
+                channel_id = channel_data.get("channelId")
+                if channel_id in channels:
+                    cache.store(channel_id, day, channel_data.get("programmes") or [])
+                    stored.add(channel_id)
+        for channel_id in channels:
+            # channels without programmes are stored too, so we don't ask again
+            if channel_id not in stored:
+                cache.store(channel_id, day, [])
+    # programmes are loaded lazily, so only one channel is kept in memory at once
+    return {
+        "results": (
+            {"channelId": channel_id, "programmes": cache.load(channel_id, day)}
+            for channel_id in channels
+        )
+    }
+
+
+def _fetch_epg_window(
+    addon: xbmcaddon.Addon,
+    session: Session,
+    channels: list,
+    from_time: int,
+    to_time: int,
+) -> Iterator[dict]:
+    """
+    Fetch one window of EPG data for a chunk of channels.
+
+    :param addon: The addon object.
+    :param session: The requests session to use.
+    :param channels: The list of channel IDs to fetch.
+    :param from_time: Start of the window in unix time.
+    :param to_time: End of the window in unix time.
+
+    :return: Iterator of the per channel results in JSON format.
+    """
+    return media_list.iter_epg(
+        session,
+        static.get_api_base(),
+        addon.getSetting("accesstoken"),
+        channels,
+        from_time,
+        to_time,
+        [
+            "id",
+            "title",
+            "Description",
+            "Ratings",
+            "period",
+            "editorial.SeasonNumber",
+            "editorial.episodeNumber",
+            "editorial.technicals.media.AV_PlaylistName",
+            "editorial.technicals.deviceType",
+            "Episode",
+            "editorial.contentType",
+            "editorial.Countries",
+            session.device_properties["catchup_control"],
+            session.device_properties["npvr_control"],
+            # "Year",
+            # "Genres",
+            # "Actors",
+            # NOTE: Unfortunately these aren't part of the provider's
+            # model when querying /epg. /epg/now and all other return it...
+            # If a developer sees it, please add it to the provider config :^). Thanks!
+        ],
+    )
+
+
+def _write_programmes(
+    f: BufferedWriter,
+    addon: xbmcaddon.Addon,
+    session: Session,
+    programs: dict,
+    previous: set,
+    written: set,
+    is_killed: threading.Event = None,
+) -> bool:
+    """
+    Write the programmes of an EPG response to the XMLTV file.
+
+    :param f: The file to write to.
+    :param addon: The addon object.
+    :param session: The requests session used for the export.
+    :param programs: The EPG response in JSON format.
+    :param previous: The (channel ID, programme ID) pairs written for the previous day of the chunk.
+    :param written: The pairs written for this day of the chunk. Updated in place.
+    :param is_killed: The threading.Event object to check if the export was cancelled.
+
+    :return: False if the export was cancelled, True otherwise.
+    """
+    for channel_data in programs.get("results") or []:
+        if is_killed and is_killed.is_set():
+            return False
+
+        channel_id = channel_data.get("channelId")
+        if not channel_id:
+            # can't continue without a channel ID
+            continue
+        for program in channel_data.get("programmes") or []:
+            if is_killed and is_killed.is_set():
+                return False
+
+            epg_id = program.get("id")
+            period = program.get("period") or {}
+            start = period.get("start")
+            end = period.get("end")
+
+            if not all([epg_id, start, end]):
+                # can't continue at least without so much data
+                continue
+            if (channel_id, epg_id) in previous or (channel_id, epg_id) in written:
+                continue
+            written.add((channel_id, epg_id))
+            start_epg, end_epg = unix_to_epg_time(start), unix_to_epg_time(end)
+
+            name = program.get("title") or addon.getLocalizedString(30056)
+            description = program.get("Description") or ""
+            editorial = program.get("editorial") or {}
+            technicals = editorial.get("technicals") or []
+            season_number = editorial.get("SeasonNumber")
+            episode_number = editorial.get("episodeNumber")
+            content_type = editorial.get("contentType")
+            episode_name = program.get("Episode") or ""
+            countries = (editorial.get("Countries") or "").split(";")
+            catchup_control = (
+                program.get(session.device_properties["catchup_control"]) or "0"
+            ) == "1"
+            npvr_control = (
+                program.get(session.device_properties["npvr_control"]) or "0"
+            ) == "1"
+
+            icon = f"{static.get_imageservice_base()}/images/v1/image/movie/{epg_id}/banner?aspect=16x9&imageFormat=webp&width=320"
+            if content_type in ["episode", "tvshow"]:
+                icon = f"{static.get_imageservice_base()}/images/v1/image/episode/{epg_id}/episode?aspect=16x9&imageFormat=webp&width=320"
+
+            av_playlist = next(
+                (
+                    (technical.get("media") or {}).get("AV_PlaylistName") or {}
+                    for technical in technicals
+                    if session.device_properties["nagra_device_type"]
+                    in (technical.get("deviceType") or [])
+                ),
+                {},
+            )
+            media_url = av_playlist.get("uri") or ""
+            drm_id = av_playlist.get("drmId") or ""
+
+            catchup_url = f"plugin://{addon.getAddonInfo('id')}/?action=catchup&id={enc_xml(drm_id)}&url={quote_plus(media_url)}&start={start}&end={end}&epg_id={epg_id}"
+            to_catchup = False
+            if media_url and drm_id:
+                if npvr_control:
+                    catchup_url += "&rec=1"
+                    to_catchup = True
+                else:
+                    catchup_url += "&rec=0"
+                if catchup_control:
+                    catchup_url += "&res=1"
+                    to_catchup = True
+                else:
+                    catchup_url += "&res=0"
+
+            # epg content
+            f.write(
+                f'<programme start="{enc_xml(start_epg)}" stop="{enc_xml(end_epg)}" channel="{enc_xml(channel_id)}"'
+            )
+            if to_catchup:
+                f.write(f' catchup-id="{enc_xml(catchup_url)}"')
+            f.write(">")
+
+            f.write(f'<title lang="hu">{enc_xml(name)}</title>')
+            f.write(f'<desc lang="hu">{enc_xml(description)}</desc>')
+            f.write(f'<icon src="{enc_xml(icon)}"/>')
+
+            if all([episode_number, season_number]):
+                f.write(
+                    f'<episode-num system="xmltv_ns">{enc_xml(str(season_number - 1))}.{enc_xml(str(episode_number - 1))}.</episode-num>'
+                )
+
+            # currently not supported by Kodi, but nice to have
+            countries = [
+                f"<country>{enc_xml(country)}</country>" for country in countries
+            ]
+            if countries:
+                f.write("".join(countries))
+
+            if episode_name:
+                f.write(f'<sub-title lang="hu">{enc_xml(episode_name)}</sub-title>')
+
+            f.write("</programme>")
+    return True
+
+
 def export_epg(
     addon: xbmcaddon.Addon,
     session: Session,
@@ -190,7 +432,8 @@ def export_epg(
     :param session: The requests session to use.
     :param from_time: str of days back from the current time you wish to fetch EPG data from.
     :param to_time: str of days forth from the current time you wish to fetch EPG data from.
-    :param is_killed: The threading.Event object to check if the thread is killed. Returns if set.
+    :param is_killed: The threading.Event object to check if the thread is killed. Returns if set
+     and cancels the EPG requests that haven't been completed yet.
 
     :return: None
     """
@@ -215,36 +458,14 @@ def export_epg(
     # get the list of channels the user is entitled to in a list
     # form with channel IDs
 
-    entitlements = get_user_entitlements(session)
-
-    try:
-        service_list = media_list.get_channel_list(
-            session, static.get_api_base(), addon.getSetting("accesstoken")
-        )
-    except HTTPError as e:
-        xbmc.log(format_exc(), xbmc.LOGERROR)
-        # show error dialog and exit
-        dialog = xbmcgui.Dialog()
-        dialog.ok(
-            addon.getAddonInfo("name"),
-            addon.getLocalizedString(30019).format(
-                status=e.response.status_code, body=e.response.text
-            ),
-        )
-        exit()
-
     channels = []
 
-    for service in service_list.get("services") or []:
+    for channel in get_channel_catalogue(session):
         if is_killed and is_killed.is_set():
             return
 
-        editorial = service.get("editorial", {})
-        technical = service.get("technical", {})
-
-        channel_id = editorial.get("id") or editorial.get("_id")
-        name = editorial.get("longName", addon.getLocalizedString(30056))
-        if not channel_id:
+        name = channel.name or addon.getLocalizedString(30056)
+        if not channel.id:
             # without a channel ID we can't uniquely identify the channel
             xbmc.log(
                 f"Skipping channel {name}, missing channel ID",
@@ -252,33 +473,34 @@ def export_epg(
             )
             continue
 
-        product_refs = technical.get("productRefs") or []
-        if not any([product_ref in entitlements for product_ref in product_refs]):
-            # user is not entitled to this channel
-            xbmc.log(
-                f"Skipping channel {name}, user not entitled",
-                xbmc.LOGDEBUG,
-            )
-            continue
-
-        icon = f"{static.get_imageservice_base()}/images/v1/image/channel/{channel_id}/logo?aspect=1x1&height=256&imageFormat=webp&width=256"
-
         channels.append(
             {
-                "id": channel_id,
+                "id": channel.id,
                 "name": name,
-                "icon": icon,
+                "icon": channel.logo(static.get_imageservice_base()),
             }
         )
 
-    del service_list
-    del entitlements
-
     temp_path = path + ".tmp"
     chunk_size = addon.getSettingInt("epgfetchinonereq")
+    volatile_days = addon.getSettingInt("epgvolatiledays")
+    cache = EPGCache(
+        get_profile_path(f"epgcache/{session.device_properties['nagra_device_type']}")
+    )
 
     # write XML
-    with xbmcvfs.File(temp_path, "w") as f:
+    # NOTE: every write on a VFS file is a round trip through Kodi, so the
+    # output is collected in a buffer and written in large blocks
+    # the document is also gzip compressed on the fly if enabled
+    with xbmcvfs.File(temp_path, "w") as vfs_file, BufferedWriter(
+        vfs_file,
+        addon.getSettingInt("epgwritebuffer") * 1024,
+        (
+            addon.getSettingInt("epgcompresslevel")
+            if addon.getSettingBool("epgcompress")
+            else None
+        ),
+    ) as f:
         # based on info from https://github.com/XMLTV/xmltv/blob/master/xmltv.dtd
 
         # XML header
@@ -309,62 +531,79 @@ def export_epg(
 
         del channel_ids, channels
 
-        for chunk in chunked_channel_ids:
-            if is_killed and is_killed.is_set():
-                return
-
-            # NOTE: from and to time is in string format
-            # it indicates the days back and forth from the current time
-            # e.g. 1 and 1 means 1 day back and 1 day forth from the current time
-            # but we can only fetch a max of 1 day back and forth in one request
-            # so we need to fetch multiple times if the range is bigger
-
-            from_days = int(from_time)
-            to_days = int(to_time)
-            start_time = int(time())
-
-            time_ranges = []
-
-            for i in range(-from_days, to_days):
-                # NOTE: time could be '<num>d' format, but with unix time we make sure its exact
-                # we can only request 1d worth of content per request, so if from is 1, to is 3,
-                # we get [(-1, 0), (0, 1), (1, 2), (2, 3)] (in relative days here for better readability)
-                _from_time = start_time + i * 86400
-                _to_time = start_time + (i + 1) * 86400
-                time_ranges.append((_from_time, _to_time))
+        # NOTE: from and to time is in string format
+        # it indicates the days back and forth from the current time
+        # e.g. 1 and 1 means 1 day back and 1 day forth from the current time
+        # but we can only fetch a max of 1 day back and forth in one request
+        # so we need to fetch multiple times if the range is bigger
+
+        from_days = int(from_time)
+        to_days = int(to_time)
+        today = int(time()) // 86400
+
+        # NOTE: requests are aligned to UTC days, so that they can be cached
+        # if from is 1, to is 3, we get the buckets [-1, 0, 1, 2, 3] (relative to today),
+        # which covers the same time range as the unaligned [now - 1d, now + 3d] window
+        days = list(range(today - from_days, today + to_days + 1))
+        cache.prune(days[0], days[-1])
+
+        # every (chunk, day) pair is an independent request, so we load them
+        # with a bounded worker pool, but consume the results in submission order
+        # to keep the XMLTV output in a deterministic channel/time order
+        jobs = iter(
+            [
+                (
+                    chunk,
+                    day,
+                    _needs_refresh(cache, chunk, day, today, volatile_days),
+                )
+                for chunk in chunked_channel_ids
+                for day in days
+            ]
+        )
+        workers = max(1, addon.getSettingInt("epgworkers"))
+        executor = ThreadPoolExecutor(max_workers=workers)
+        pending = deque()
+
+        def submit_next() -> None:
+            job = next(jobs, None)
+            if job:
+                pending.append(
+                    (
+                        job,
+                        executor.submit(
+                            _load_epg_window,
+                            addon,
+                            session,
+                            cache,
+                            *job,
+                            is_killed=is_killed,
+                        ),
+                    )
+                )
 
-            for _from_time, _to_time in time_ranges:
+        try:
+            # keep a few requests queued ahead of the one we are writing,
+            # so the workers never idle, but memory usage stays bounded
+            for _ in range(workers * 2):
+                submit_next()
+
+            # programmes around midnight are part of two day buckets,
+            # jobs come chunk by chunk and day by day, so only the IDs of the
+            # previous day of the same chunk have to be remembered
+            last_chunk, previous, written = None, set(), set()
+
+            while pending:
+                if is_killed and is_killed.is_set():
+                    return
+
+                (chunk, _, _), future = pending.popleft()
+                if chunk is not last_chunk:
+                    last_chunk, previous, written = chunk, set(), set()
+                else:
+                    previous, written = written, set()
                 try:
-                    programs = media_list.get_epg(
-                        session,
-                        static.get_api_base(),
-                        addon.getSetting("accesstoken"),
-                        chunk,
-                        _from_time,
-                        _to_time,
-                        [
-                            "id",
-                            "title",
-                            "Description",
-                            "Ratings",
-                            "period",
-                            "editorial.SeasonNumber",
-                            "editorial.episodeNumber",
-                            "editorial.technicals.media.AV_PlaylistName",
-                            "editorial.technicals.deviceType",
-                            "Episode",
-                            "editorial.contentType",
-                            "editorial.Countries",
-                            session.device_properties["catchup_control"],
-                            session.device_properties["npvr_control"],
-                            # "Year",
-                            # "Genres",
-                            # "Actors",
-                            # NOTE: Unfortunately these aren't part of the provider's
-                            # model when querying /epg. /epg/now and all other return it...
-                            # If a developer sees it, please add it to the provider config :^). Thanks!
-                        ],
-                    )
+                    programs = future.result()
                 except HTTPError as e:
                     xbmc.log(format_exc(), xbmc.LOGERROR)
                     # show error dialog and exit
@@ -376,113 +615,20 @@ def export_epg(
                         ),
                     )
                     exit()
+                submit_next()
 
-                for channel_data in programs.get("results") or []:
-                    if is_killed and is_killed.is_set():
-                        return
-
-                    channel_id = channel_data.get("channelId")
-                    if not channel_id:
-                        # can't continue without a channel ID
-                        continue
-                    for program in channel_data.get("programmes") or []:
-                        if is_killed and is_killed.is_set():
-                            return
-
-                        epg_id = program.get("id")
-                        period = program.get("period") or {}
-                        start = period.get("start")
-                        end = period.get("end")
-
-                        if not all([epg_id, start, end]):
-                            # can't continue at least without so much data
-                            continue
-                        start_epg, end_epg = unix_to_epg_time(start), unix_to_epg_time(
-                            end
-                        )
-
-                        name = program.get("title") or addon.getLocalizedString(30056)
-                        description = program.get("Description") or ""
-                        editorial = program.get("editorial") or {}
-                        technicals = editorial.get("technicals") or []
-                        season_number = editorial.get("SeasonNumber")
-                        episode_number = editorial.get("episodeNumber")
-                        content_type = editorial.get("contentType")
-                        episode_name = program.get("Episode") or ""
-                        countries = (editorial.get("Countries") or "").split(";")
-                        catchup_control = (
-                            program.get(session.device_properties["catchup_control"])
-                            or "0"
-                        ) == "1"
-                        npvr_control = (
-                            program.get(session.device_properties["npvr_control"])
-                            or "0"
-                        ) == "1"
-
-                        icon = f"{static.get_imageservice_base()}/images/v1/image/movie/{epg_id}/banner?aspect=16x9&imageFormat=webp&width=320"
-                        if content_type in ["episode", "tvshow"]:
-                            icon = f"{static.get_imageservice_base()}/images/v1/image/episode/{epg_id}/episode?aspect=16x9&imageFormat=webp&width=320"
-
-                        av_playlist = next(
-                            (
-                                (technical.get("media") or {}).get("AV_PlaylistName")
-                                or {}
-                                for technical in technicals
-                                if session.device_properties["nagra_device_type"]
-                                in (technical.get("deviceType") or [])
-                            ),
-                            {},
-                        )
-                        media_url = av_playlist.get("uri") or ""
-                        drm_id = av_playlist.get("drmId") or ""
-
-                        catchup_url = f"plugin://{addon.getAddonInfo('id')}/?action=catchup&id={enc_xml(drm_id)}&url={quote_plus(media_url)}&start={start}&end={end}&epg_id={epg_id}"
-                        to_catchup = False
-                        if media_url and drm_id:
-                            if npvr_control:
-                                catchup_url += "&rec=1"
-                                to_catchup = True
-                            else:
-                                catchup_url += "&rec=0"
-                            if catchup_control:
-                                catchup_url += "&res=1"
-                                to_catchup = True
-                            else:
-                                catchup_url += "&res=0"
-
-                        # epg content
-                        f.write(
-                            f'<programme start="{enc_xml(start_epg)}" stop="{enc_xml(end_epg)}" channel="{enc_xml(channel_id)}"'
-                        )
-                        if to_catchup:
-                            f.write(f' catchup-id="{enc_xml(catchup_url)}"')
-                        f.write(">")
-
-                        f.write(f'<title lang="hu">{enc_xml(name)}</title>')
-                        f.write(f'<desc lang="hu">{enc_xml(description)}</desc>')
-                        f.write(f'<icon src="{enc_xml(icon)}"/>')
-
-                        if all([episode_number, season_number]):
-                            f.write(
-                                f'<episode-num system="xmltv_ns">{enc_xml(str(season_number - 1))}.{enc_xml(str(episode_number - 1))}.</episode-num>'
-                            )
-
-                        # currently not supported by Kodi, but nice to have
-                        countries = [
-                            f"<country>{enc_xml(country)}</country>"
-                            for country in countries
-                        ]
-                        if countries:
-                            f.write("".join(countries))
-
-                        if episode_name:
-                            f.write(
-                                f'<sub-title lang="hu">{enc_xml(episode_name)}</sub-title>'
-                            )
-
-                        f.write("</programme>")
+                if not _write_programmes(
+                    f, addon, session, programs, previous, written, is_killed
+                ):
+                    return
 
                 del programs
+        finally:
+            # drop everything that hasn't started yet, requests already in flight
+            # check is_killed before they start and their results are discarded
+            for _, future in pending:
+                future.cancel()
+            executor.shutdown(wait=False)
 
         f.write("</tv>")
 
@@ -557,7 +703,7 @@ class EPGUpdaterThread(threading.Thread):
                 and not self.failed_count > self.addon.getSettingInt("epgfetchtries")
             ):
                 try:
-                    authenticate(self.session, self.addon)
+                    authenticate(self.session, self.addon, interactive=False)
                     export_epg(
                         self.addon,
                         self.session,
@@ -610,21 +756,149 @@ def restart_on_settings_change(thread: EPGUpdaterThread, handle: str) -> None:
 """
 
 
-def epg_fetcher() -> None:
+class CatalogueRefresherThread(threading.Thread):
+    """
+    A thread that revalidates the persistent channel catalogue cache in the background
+     whenever a plugin invocation served expired data from it.
     """
-    Main function to start the EPG updater.
 
-    :return: None
+    def __init__(self, addon: xbmcaddon.Addon, session: Session, interval: int = 5):
+        super().__init__()
+        self.addon = addon
+        self.session = session
+        self.interval = interval
+        self.killed = threading.Event()
+
+    @property
+    def handle(self) -> str:
+        """Returns the addon handle"""
+        return f"[{self.addon.getAddonInfo('name')}]"
+
+    def run(self) -> None:
+        """
+        Catalogue refresher thread's main loop.
+        """
+        window = xbmcgui.Window(static.HOME_ID)
+        while not self.killed.wait(self.interval):
+            if window.getProperty(CATALOGUE_REFRESH_PROPERTY) != "true":
+                continue
+            window.clearProperty(CATALOGUE_REFRESH_PROPERTY)
+            try:
+                authenticate(self.session, self.addon, interactive=False)
+                # NOTE: not using get_channel_catalogue, we don't want dialogs here
+                catalogue.get_catalogue(
+                    self.session,
+                    static.get_api_base(),
+                    self.addon.getSetting("accesstoken"),
+                    cache=get_response_cache(),
+                    scope=self.addon.getSetting("username"),
+                    refresh=True,
+                )
+                xbmc.log(f"{self.handle} Channel catalogue refreshed", xbmc.LOGINFO)
+            except Exception:
+                xbmc.log(
+                    f"{self.handle} Channel catalogue refresh failed: {format_exc()}",
+                    xbmc.LOGERROR,
+                )
+
+    def stop(self) -> None:
+        """
+        Sets stop event to the thread.
+        """
+        self.killed.set()
+
+
+class TokenKeeperThread(threading.Thread):
     """
-    addon = xbmcaddon.Addon()
+    A thread that refreshes the access token in the background before it expires,
+     so plugin invocations always find a valid token and never wait for a login.
+    """
+
+    def __init__(self, addon: xbmcaddon.Addon, session: Session, interval: int = 60):
+        super().__init__()
+        self.addon = addon
+        self.session = session
+        self.interval = interval
+        self.killed = threading.Event()
+        self.failed_count = 0
+
+    @property
+    def now(self) -> int:
+        """Returns the current time in unix format"""
+        return int(time())
+
+    @property
+    def handle(self) -> str:
+        """Returns the addon handle"""
+        return f"[{self.addon.getAddonInfo('name')}]"
+
+    def next_refresh(self) -> int:
+        """
+        Calculates when the access token should be refreshed, based on the
+         configured fraction of its lifetime.
 
+        :return: The unix time of the next refresh, 0 if it's due now.
+        """
+        expiry = self.addon.getSetting("accessexpiry")
+        issued = self.addon.getSetting("accessissued")
+        if not expiry or not issued:
+            # no token yet or it was issued before we started to keep track
+            return 0
+        expiry, issued = int(expiry), int(issued)
+        ratio = self.addon.getSettingInt("tokenrefreshratio") / 100
+        return issued + int((expiry - issued) * ratio)
+
+    def run(self) -> None:
+        """
+        Token keeper thread's main loop.
+        """
+        while not self.killed.is_set():
+            if not all(
+                [self.addon.getSetting("username"), self.addon.getSetting("password")]
+            ):
+                self.killed.wait(self.interval)
+                continue
+            # NOTE: wake up regularly, the plugin might have logged in meanwhile
+            delay = self.next_refresh() - self.now
+            if delay > 0:
+                self.killed.wait(min(delay, self.interval))
+                continue
+            try:
+                authenticate(
+                    self.session, self.addon, force_refresh=True, interactive=False
+                )
+                self.failed_count = 0
+                xbmc.log(f"{self.handle} Access token refreshed", xbmc.LOGINFO)
+            except Exception:
+                self.failed_count += 1
+                xbmc.log(
+                    f"{self.handle} Access token refresh failed: {format_exc()}",
+                    xbmc.LOGERROR,
+                )
+                # back off, the plugin will still authenticate on its own
+                self.killed.wait(min(self.interval * 2**self.failed_count, 3600))
+
+    def stop(self) -> None:
+        """
+        Sets stop event to the thread.
+        """
+        self.killed.set()
+
+
+def epg_fetcher(addon: xbmcaddon.Addon) -> EPGUpdaterThread:
+    """
+    Starts the EPG updater if it's enabled and configured.
+
+    :param addon: The addon object.
+    :return: The started EPG updater thread or None.
+    """
     handle = f"[{addon.getAddonInfo('name')}]"
     session = prepare_session()
     session.device_properties = prepare_device()
 
     auto_update = addon.getSettingBool("autoupdateepg")
     if not auto_update:
-        xbmc.log(f"{handle} EPG updater disabled, aborting", xbmc.LOGINFO)
+        xbmc.log(f"{handle} EPG updater disabled", xbmc.LOGINFO)
         return
 
     from_time = addon.getSetting("epgfrom")
@@ -646,6 +920,51 @@ def epg_fetcher() -> None:
     )
     epg_thread.start()
     xbmc.log(f"{handle} EPG updater started", xbmc.LOGINFO)
+    return epg_thread
+
+
+def run_service() -> None:
+    """
+    Main function of the background service. Starts the background threads
+     and keeps them running until Kodi exits.
+
+    :return: None
+    """
+    addon = xbmcaddon.Addon()
+    handle = f"[{addon.getAddonInfo('name')}]"
+
+    threads = []
+
+    epg_thread = epg_fetcher(addon)
+    if epg_thread:
+        threads.append(epg_thread)
+
+    session = prepare_session()
+    session.device_properties = prepare_device()
+
+    try:
+        # free the DRM sessions plugin processes left behind in the last run
+        teardown_orphaned_sessions(session, get_session_ledger())
+    except Exception:
+        xbmc.log(f"{handle} Orphan teardown failed: {format_exc()}", xbmc.LOGERROR)
+
+    refresher_thread = CatalogueRefresherThread(addon, session)
+    refresher_thread.start()
+    threads.append(refresher_thread)
+
+    token_thread = TokenKeeperThread(addon, session)
+    token_thread.start()
+    threads.append(token_thread)
+    xbmc.log(f"{handle} Token keeper started", xbmc.LOGINFO)
+
+    try:
+        licproxy_thread = run_persistent_server(addon)
+    except (OSError, ValueError):
+        # play() falls back to a proxy of its own
+        licproxy_thread = None
+        xbmc.log(f"{handle} License proxy failed: {format_exc()}", xbmc.LOGERROR)
+    if licproxy_thread:
+        threads.append(licproxy_thread)
 
     # monitor = EPGMonitor(
     #    action=lambda: restart_on_settings_change(epg_thread, handle), handle=handle
@@ -655,15 +974,17 @@ def epg_fetcher() -> None:
     while not monitor.abortRequested():
         if monitor.waitForAbort(1):
             break
-    if epg_thread and epg_thread.is_alive():
-        epg_thread.stop()
-        try:
-            epg_thread.join()
-        except RuntimeError:
-            pass
-        xbmc.log(f"{handle} EPG updater stopped", xbmc.LOGINFO)
+    xbmcgui.Window(static.HOME_ID).clearProperty(PORT_PROPERTY)
+    for thread in threads:
+        if thread.is_alive():
+            thread.stop()
+            try:
+                thread.join()
+            except RuntimeError:
+                pass
+    xbmc.log(f"{handle} Background service stopped", xbmc.LOGINFO)
 
 
 if __name__ == "__main__":
     # path triggered when the plugin is run as a script
-    epg_fetcher()
+    run_service()
@@ -1,22 +1,45 @@
+import errno
+import selectors
+import socket
 import threading
 from base64 import b64decode, b64encode
+from contextlib import contextmanager
 from json import load
-from random import randint
+from queue import Queue
 from socketserver import ThreadingMixIn
+from time import perf_counter, sleep, time
 from traceback import format_exc
-from typing import Union
+from typing import Iterator, Tuple, Union
 from unicodedata import normalize
+from urllib.parse import urlparse
+from uuid import uuid4
 from wsgiref.simple_server import WSGIRequestHandler, WSGIServer, make_server
 
 import requests
 import xbmc
 import xbmcaddon
-from bottle import default_app, hook, request, response, route
-from resources.lib.utils import is_android, prepare_session
+import xbmcgui
+from bottle import Bottle, request, response
+from resources.lib.utils import is_android, preconnect, prepare_session
+from resources.lib.utils.ledger import ACTIVE, ENDED, get_session_ledger
+from resources.lib.utils.metrics import Metrics
+from resources.lib.utils.licproxy import (
+    BROKER_MARK_HEADER,
+    BROKER_METHOD_HEADER,
+    BROKER_PRECONNECT_HEADER,
+    BROKER_TIMEOUT_HEADER,
+    BROKER_URL_HEADER,
+    PORT_PROPERTY,
+    get_broker_hosts,
+    parse_broker_timeout,
+)
+from resources.lib.van import playback, static
 
 """
-This file contains a lightweight web server. Don't worry, it only runs
-when you have an active playback.
+This file contains a lightweight web server. It's started once by the
+ background service and every playback registers its own session on it,
+ so starting a channel doesn't have to wait for a server to come up.
+ If the service is not running, play() starts a server just for itself.
 
 Unfortunately the provider implements its Widevine DRM support with a few
  non standard quirks. Kodi's ISA has no support for those. We need to handle
@@ -35,6 +58,12 @@ This module is a workaround for the following issues:
 """
 
 
+# Widevine service certificate request, sent by Android before the real challenge
+SERVICE_CERT_REQUEST = b"\x08\x04"
+# the certificate is effectively static, but let's not keep it forever
+SERVICE_CERT_TTL = 24 * 3600
+
+
 class SilentWSGIRequestHandler(WSGIRequestHandler):
     """Custom WSGI Request Handler with logging disabled"""
 
@@ -50,10 +79,91 @@ class ThreadedWSGIServer(ThreadingMixIn, WSGIServer):
 
     allow_reuse_address = True
     daemon_threads = True
-    timeout = 1
 
 
-@hook("before_request")
+class LicenseSession:
+    """
+    State of a single playback session on the proxy.
+
+    Requests are served concurrently, so the mutable state is guarded by a lock.
+     Renewals are also serialized with a separate lock: ISA might send a renewal
+     and a retry at once and both must not use a session token that's just being
+     replaced. Initial license requests don't wait for each other.
+    """
+
+    def __init__(
+        self, license_url: str, renewal_url: str, session_token: str, teardown_url: str
+    ) -> None:
+        self.license_url = license_url
+        self.renewal_url = renewal_url
+        self.teardown_url = teardown_url
+        # the session ledger knows the session by its first token
+        self.ledger_key = session_token
+        self.registered = time()
+        self.lock = threading.Lock()
+        self.renewal_lock = threading.Lock()
+        self._session_token = session_token
+        self._renewing = False
+        self._renewals = 0
+
+    @property
+    def session_token(self) -> str:
+        """Returns the current session token"""
+        with self.lock:
+            return self._session_token
+
+    @property
+    def renewals(self) -> int:
+        """Returns the number of renewals so far"""
+        with self.lock:
+            return self._renewals
+
+    def snapshot(self) -> Tuple[bool, str]:
+        """
+        Reads the state consistently.
+
+        :return: Tuple of the renewal mode and the current session token.
+        """
+        with self.lock:
+            return self._renewing, self._session_token
+
+    def switch_to_renewal(self) -> None:
+        """
+        Switches the session to renewal mode after the first license.
+
+        :return: None
+        """
+        with self.lock:
+            self._renewing = True
+
+    def renewed(self, session_token: str = None) -> None:
+        """
+        Records a renewal and the new session token, if any.
+
+        :param session_token: The new session token.
+        :return: None
+        """
+        with self.lock:
+            self._renewals += 1
+            if session_token:
+                self._session_token = session_token
+
+    @contextmanager
+    def guard(self) -> Iterator[None]:
+        """
+        Serializes the request with other renewals if the session is in renewal mode.
+
+        :return: Context manager.
+        """
+        with self.lock:
+            renewing = self._renewing
+        if not renewing:
+            yield
+            return
+        with self.renewal_lock:
+            yield
+
+
 def set_server_header() -> None:
     """
     Sets a Server header with the app's name for all successful responses.
@@ -63,7 +173,6 @@ def set_server_header() -> None:
     response.set_header("Server", request.app.config["name"])
 
 
-@route("/")
 def index() -> str:
     """
     Returns a welcome message for the root path.
@@ -75,8 +184,173 @@ def index() -> str:
     return request.app.config["welcome_text"]
 
 
-@route("/wv/license", method=["POST"])
-def license() -> Union[dict, bytes]:
+def get_metrics() -> str:
+    """
+    Exposes the counters and latency histograms of the proxy
+     in the Prometheus text format.
+
+    :return: The metrics.
+    """
+    response.content_type = "text/plain; version=0.0.4"
+    return request.app.config["metrics"].render()
+
+
+def log_session_summary(
+    app_config: dict, session_id: str, license_session: LicenseSession
+) -> None:
+    """
+    Logs the renewal count of an ending session and the summary of the proxy metrics.
+
+    :param app_config: The config of the app.
+    :param session_id: The ID of the session.
+    :param license_session: The state of the session.
+    :return: None
+    """
+    xbmc.log(
+        f"License proxy session {session_id} ended after {license_session.renewals} renewals, metrics: {app_config['metrics'].summary()}",
+        xbmc.LOGINFO,
+    )
+
+
+def broker() -> Union[dict, Iterator[bytes]]:
+    """
+    API broker route. Forwards a provider request of a plugin invocation
+     through the pooled session of the service, so the plugin doesn't have
+     to open its own TLS connections. Only provider hosts are allowed.
+
+    The target is given in the X-Broker-Method and X-Broker-Url headers and
+     the plugin's timeouts in X-Broker-Timeout, the rest of the headers and
+     the body are forwarded as-is. Brokered responses are marked with the
+     X-Broker header. Unmarked responses are failures of the broker itself:
+     a 403 means the plugin should connect directly, a 502 means the request
+     may have reached the provider and must not be resent.
+
+    :return: An iterator over the upstream response body.
+    """
+    app_config = request.app.config
+    method = request.headers.get(BROKER_METHOD_HEADER, "GET")
+    url = request.headers.get(BROKER_URL_HEADER, "")
+    if urlparse(url).netloc not in app_config["broker_hosts"]:
+        response.status = 403
+        return {"error": "Host not allowed"}
+
+    headers = {
+        key: value
+        for key, value in request.headers.items()
+        if key
+        not in (
+            "Host",
+            "Content-Length",
+            BROKER_METHOD_HEADER,
+            BROKER_URL_HEADER,
+            BROKER_PRECONNECT_HEADER,
+            BROKER_TIMEOUT_HEADER,
+        )
+    }
+    session = app_config["session"]
+    prepared = session.prepare_request(
+        requests.Request(method, url, headers=headers, data=request.body.read() or None)
+    )
+    # keeps the warm-ups of the plugin out of the performance stats
+    prepared.preconnect = request.headers.get(BROKER_PRECONNECT_HEADER) == "1"
+    start = perf_counter()
+    try:
+        upstream = session.send(
+            prepared,
+            allow_redirects=False,
+            # without the plugin's timeouts, the session's configured ones apply
+            timeout=parse_broker_timeout(request.headers.get(BROKER_TIMEOUT_HEADER)),
+            # NOTE: large responses (like the channel list) are passed through
+            # in chunks instead of being held in memory
+            stream=True,
+        )
+    except requests.RequestException:
+        xbmc.log(f"Brokered request to {url} failed: {format_exc()}", xbmc.LOGERROR)
+        response.status = 502
+        return {"error": "Failed to broker request"}
+    app_config["metrics"].observe("broker_latency_seconds", perf_counter() - start)
+    app_config["metrics"].inc(
+        "broker_responses_total", {"status": upstream.status_code}
+    )
+
+    response.status = upstream.status_code
+    for key, value in upstream.headers.items():
+        # the body is already decoded and the length is calculated by the web server
+        if key not in (
+            "Transfer-Encoding",
+            "Content-Encoding",
+            "Content-Length",
+            "Connection",
+        ):
+            response.set_header(key, value)
+    response.set_header(BROKER_MARK_HEADER, "1")
+    return _iter_upstream(upstream)
+
+
+def _iter_upstream(upstream: requests.Response) -> Iterator[bytes]:
+    """
+    Iterates over the decoded body of a brokered response, then releases
+     its connection back to the pool.
+
+    :param upstream: The upstream response, requested with stream=True.
+    :return: An iterator over the chunks of the body.
+    """
+    try:
+        yield from upstream.iter_content(chunk_size=65536)
+    except requests.RequestException:
+        # the status line is already sent, the plugin sees a truncated body
+        xbmc.log(
+            f"Brokered response of {upstream.url} broke: {format_exc()}", xbmc.LOGERROR
+        )
+    finally:
+        upstream.close()
+
+
+def register_session() -> dict:
+    """
+    Registers a new playback session. Expects a JSON body with the
+     license_url, renewal_url, session_token and teardown_url keys.
+    The URLs must point to the provider's hosts, so the server can't be used
+     to send requests anywhere else when it listens on a LAN address.
+
+    :return: The ID of the session.
+    """
+    data = request.json or {}
+    keys = ("license_url", "renewal_url", "session_token", "teardown_url")
+    if not all(data.get(key) for key in keys):
+        response.status = 400
+        return {"error": "Missing session parameters"}
+    for key in ("license_url", "renewal_url", "teardown_url"):
+        if urlparse(data[key]).netloc not in request.app.config["broker_hosts"]:
+            response.status = 400
+            return {"error": f"Host of {key} not allowed"}
+    session_id = uuid4().hex
+    request.app.config["sessions"][session_id] = LicenseSession(
+        **{key: data[key] for key in keys}
+    )
+    # ISA sends the first license request right after the playback starts
+    preconnect(request.app.config["session"], [data["license_url"]])
+    xbmc.log(f"Registered license proxy session {session_id}", xbmc.LOGDEBUG)
+    return {"id": session_id}
+
+
+def unregister_session(session_id: str) -> dict:
+    """
+    Unregisters a playback session and sends the teardown call for it.
+
+    :param session_id: The ID of the session.
+    :return: Empty dict.
+    """
+    license_session = request.app.config["sessions"].pop(session_id, None)
+    if not license_session:
+        response.status = 404
+        return {"error": "Unknown session"}
+    request.app.config["teardown_worker"].submit(license_session)
+    log_session_summary(request.app.config, session_id, license_session)
+    return {}
+
+
+def license(session_id: str) -> Union[dict, bytes]:
     """
     License proxy route for Widevine license requests.
     This is a workaround, because the policy specifies a 5 minute license validity.
@@ -90,15 +364,35 @@ def license() -> Union[dict, bytes]:
      This is also not supported by ISA. So we seamlessly convert JSON to raw challenges
      whenever necessary.
 
-    :return: The proxied response (JSON).
+    :param session_id: The ID of the playback session.
+    :return: The proxied response (JSON or the upstream body as-is).
     """
-    app_config = request.app.config
-    session = app_config["session"]
-    license_url = app_config["license_url"]
-    renewal_url = app_config["renewal_url"]
-    session_token = app_config["session_token"]
+    license_session = request.app.config["sessions"].get(session_id)
+    if not license_session:
+        response.status = 404
+        return {"error": "Unknown session"}
+    with license_session.guard():
+        return _forward_license(session_id, license_session)
+
 
-    target_url = license_url if not app_config.get("renewing", False) else renewal_url
+def _forward_license(
+    session_id: str, license_session: LicenseSession
+) -> Union[dict, bytes]:
+    """
+    Forwards the current license request of a session, see license.
+
+    :param session_id: The ID of the playback session.
+    :param license_session: The state of the playback session.
+    :return: The proxied response (JSON or the upstream body as-is).
+    """
+    session = request.app.config["session"]
+    metrics = request.app.config["metrics"]
+    renewing, session_token = license_session.snapshot()
+    kind = "renewal" if renewing else "license"
+
+    target_url = (
+        license_session.license_url if not renewing else license_session.renewal_url
+    )
 
     headers = dict(request.headers)
     if "Host" in headers:
@@ -106,7 +400,7 @@ def license() -> Union[dict, bytes]:
 
     request_data = request.body
 
-    if app_config.get("renewing", False):
+    if renewing:
         headers["Nv-Authorizations"] = session_token
     elif is_android():
         xbmc.log(f"Android detected, sending raw challenge instead", xbmc.LOGDEBUG)
@@ -116,8 +410,24 @@ def license() -> Union[dict, bytes]:
         xbmc.log(f"Challenge: {request_data}", xbmc.LOGDEBUG)
         request_data = b64decode(request_data["challenge"])
 
+        service_cert = request.app.config["service_cert"]
+        if (
+            request_data == SERVICE_CERT_REQUEST
+            and service_cert
+            and service_cert[0] > time()
+        ):
+            _, status, cached_headers, data = service_cert
+            xbmc.log("Serving service certificate from cache", xbmc.LOGDEBUG)
+            metrics.inc("requests_total", {"kind": "service_cert_cached"})
+            response.status = status
+            _set_response_headers(cached_headers)
+            return data
+
     xbmc.log(f"Proxying request to {target_url} with headers {headers}", xbmc.LOGDEBUG)
 
+    metrics.inc("requests_total", {"kind": kind})
+    proxied_response = None
+    start = perf_counter()
     try:
         proxied_response = session.post(
             url=target_url,
@@ -128,8 +438,25 @@ def license() -> Union[dict, bytes]:
         proxied_response.raise_for_status()
     except:
         xbmc.log(f"Request to {target_url} failed: {format_exc()}", xbmc.LOGERROR)
+        # the cached certificate might be the reason, so fetch it again next time
+        request.app.config["service_cert"] = None
         response.status = 502
         return {"error": "Failed to proxy request"}
+    finally:
+        metrics.observe(
+            "upstream_latency_seconds", perf_counter() - start, {"kind": kind}
+        )
+        metrics.inc(
+            "upstream_responses_total",
+            {
+                "kind": kind,
+                "status": (
+                    proxied_response.status_code
+                    if proxied_response is not None
+                    else "error"
+                ),
+            },
+        )
 
     # these headers would mess with ISA/libcurl, therefore we remove them
     # necessary content-length header is calculated either way by the web server
@@ -150,172 +477,454 @@ def license() -> Union[dict, bytes]:
 
     xbmc.log(f"Proxy response headers: {proxied_response.headers}", xbmc.LOGDEBUG)
 
-    if "application/json" in proxied_response.headers["Content-Type"]:
-        data = proxied_response.json()
-    else:
+    content_type = proxied_response.headers.get("Content-Type", "")
+    # NOTE: by default the body is passed through as-is, it's only decoded
+    # if we have to convert it or need the renewed session token from it
+    data = proxied_response.content
+    new_session_token = None
+    if "application/octet-stream" in content_type:
         # first request on Android is a raw challenge
-        data = proxied_response.content
+        data = {"license": [b64encode(data).decode("utf-8")]}
+    elif renewing and "application/json" in content_type and b'"sessionToken"' in data:
+        new_session_token = proxied_response.json().get("sessionToken")
 
     response.status = proxied_response.status_code
-    for key, value in proxied_response.headers.items():
-        if key == "Content-Type" and "application/octet-stream" in value:
-            response.content_type = "application/json"
-        else:
-            response.set_header(key, value)
+    _set_response_headers(proxied_response.headers)
+
+    if request_data == SERVICE_CERT_REQUEST:
+        request.app.config["service_cert"] = (
+            time() + SERVICE_CERT_TTL,
+            proxied_response.status_code,
+            dict(proxied_response.headers),
+            data,
+        )
 
-    if "application/octet-stream" in proxied_response.headers["Content-Type"]:
-        data = {"license": [b64encode(data).decode("utf-8")]}
+    if renewing:
+        license_session.renewed(new_session_token)
+        metrics.inc("renewals_total")
+        metrics.mark("renewal")
 
-    if app_config.get("renewing", False) and "sessionToken" in data:
-        app_config["session_token"] = data["sessionToken"]
+    if new_session_token:
         xbmc.log(
-            f"Updated sessionToken for future requests: {data['sessionToken']}",
+            f"Updated sessionToken for future requests: {new_session_token}",
             xbmc.LOGDEBUG,
         )
-    elif (
-        not app_config.get("renewing", False)
-        and proxied_response.ok
-        and request_data != b"\x08\x04"
-    ):
+        try:
+            request.app.config["ledger"].touch(
+                license_session.ledger_key, new_session_token
+            )
+        except OSError:
+            xbmc.log(f"Session ledger update failed: {format_exc()}", xbmc.LOGERROR)
+    elif not renewing and proxied_response.ok and request_data != SERVICE_CERT_REQUEST:
         # Android requests a cert challenge with a Server Cert (\x08\x04) challenge
         # we must skip that one
-        app_config["renewing"] = True
-        xbmc.log("Switching to renewal mode for /wv/license calls", xbmc.LOGDEBUG)
+        license_session.switch_to_renewal()
+        xbmc.log(f"Switching to renewal mode for session {session_id}", xbmc.LOGDEBUG)
 
     xbmc.log(f"Proxy response: {data}", xbmc.LOGDEBUG)
 
     return data
 
 
+def _set_response_headers(headers: dict) -> None:
+    """
+    Helper, that copies the upstream headers to the response. Raw
+     responses are converted to JSON, so their content type is changed.
+
+    :param headers: The headers of the upstream response.
+    :return: None
+    """
+    for key, value in headers.items():
+        if key == "Content-Type" and "application/octet-stream" in value:
+            response.content_type = "application/json"
+        else:
+            response.set_header(key, value)
+
+
+def send_teardown(
+    session: requests.Session, license_session: LicenseSession, timeout: float = 5
+) -> bool:
+    """
+    The provider requires a teardown call which is used to tell the
+     provider that the playback session has ended. If we don't send this,
+     the provider won't let us keep more than 2 concurrent sessions every
+     5 minutes.
+
+    A 4xx answer means the provider doesn't know the session anymore,
+     that's an ended session too, like in teardown_orphaned_sessions.
+
+    :param session: The requests session to use.
+    :param license_session: The state of the playback session.
+    :param timeout: The timeout of the request in seconds.
+    :return: False if the call should be retried (connection error or 5xx).
+    """
+    teardown_url = license_session.teardown_url
+    xbmc.log(f"Sending teardown call to {teardown_url}", xbmc.LOGDEBUG)
+    try:
+        if not playback.teardown_session(
+            session, teardown_url, license_session.session_token, timeout
+        ):
+            xbmc.log("Teardown call rejected, session already gone", xbmc.LOGWARNING)
+    except requests.RequestException:
+        xbmc.log(f"Teardown call failed: {format_exc()}", xbmc.LOGERROR)
+        return False
+    try:
+        get_session_ledger().mark_ended(license_session.ledger_key)
+    except OSError:
+        xbmc.log(f"Session ledger update failed: {format_exc()}", xbmc.LOGERROR)
+    return True
+
+
+class TeardownWorker(threading.Thread):
+    """
+    Sends the teardown calls in the background through the pooled session,
+     so stopping a playback never waits for the license server.
+    Connection errors and server errors are retried a few times with a short backoff.
+    """
+
+    def __init__(
+        self, session: requests.Session, timeout: float = 5, retries: int = 3
+    ) -> None:
+        threading.Thread.__init__(self)
+        self.session = session
+        self.timeout = timeout
+        self.retries = retries
+        self.queue = Queue()
+
+    @property
+    def drain_timeout(self) -> float:
+        """Upper bound of the time needed to send a single teardown"""
+        return self.retries * self.timeout + 2**self.retries
+
+    def submit(self, license_session: LicenseSession) -> None:
+        """
+        Queues the teardown of a playback session.
+
+        :param license_session: The state of the playback session.
+        :return: None
+        """
+        self.queue.put(license_session)
+
+    def run(self) -> None:
+        """
+        Sends the queued teardowns until a stop signal is received.
+
+        :return: None
+        """
+        while True:
+            license_session = self.queue.get()
+            if license_session is None:
+                break
+            for attempt in range(self.retries):
+                if send_teardown(self.session, license_session, self.timeout):
+                    break
+                if attempt < self.retries - 1:
+                    sleep(2**attempt)
+
+    def stop(self) -> None:
+        """
+        Stops the worker after everything queued so far has been sent.
+
+        :return: None
+        """
+        self.queue.put(None)
+
+
+class SessionReaper(threading.Thread):
+    """
+    Unregisters the sessions of plugin processes that died without doing it
+     themselves, based on the heartbeats in the session ledger. Sessions still
+     running on the provider's side are torn down on the way.
+    """
+
+    def __init__(self, app_config: dict, interval: int = 30) -> None:
+        threading.Thread.__init__(self)
+        self.app_config = app_config
+        self.interval = interval
+        self.killed = threading.Event()
+
+    def reap(self) -> None:
+        """
+        Unregisters every session whose owner stopped sending heartbeats.
+
+        :return: None
+        """
+        sessions = self.app_config["sessions"]
+        ledger = self.app_config["ledger"]
+        states = ledger.states()
+        now = time()
+        for session_id, license_session in list(sessions.items()):
+            state = states.get(license_session.ledger_key)
+            if state == ACTIVE:
+                continue
+            if (
+                not state
+                and now - license_session.registered < ledger.heartbeat_timeout
+            ):
+                # NOTE: a lost ledger write is recreated by the next heartbeat
+                continue
+            if sessions.pop(session_id, None) is None:
+                # unregistered meanwhile
+                continue
+            if state != ENDED:
+                self.app_config["teardown_worker"].submit(license_session)
+            xbmc.log(
+                f"License proxy session {session_id} expired, its owner is gone",
+                xbmc.LOGINFO,
+            )
+            log_session_summary(self.app_config, session_id, license_session)
+
+    def run(self) -> None:
+        """
+        Reaps the sessions periodically until a stop signal is received.
+
+        :return: None
+        """
+        while not self.killed.wait(self.interval):
+            try:
+                self.reap()
+            except (OSError, ValueError, KeyError):
+                xbmc.log(f"Session reaping failed: {format_exc()}", xbmc.LOGERROR)
+
+    def stop(self) -> None:
+        """
+        Sets stop event to the thread.
+        """
+        self.killed.set()
+
+
+def create_app(name: str) -> Bottle:
+    """
+    Creates the web application of the license proxy. Every server gets
+     its own instance, so their configuration doesn't leak into each other.
+
+    :param name: The name of the addon, used in the Server header.
+    :return: The application.
+    """
+    app = Bottle()
+    app.config["name"] = name
+    app.config["welcome_text"] = f"{name} Web Service"
+    app.config["session"] = prepare_session()
+    app.config["sessions"] = {}
+    app.config["ledger"] = get_session_ledger()
+    app.config["service_cert"] = None
+    app.config["metrics"] = Metrics("licproxy")
+    app.config["broker_hosts"] = get_broker_hosts()
+    app.config["teardown_worker"] = TeardownWorker(app.config["session"])
+    app.add_hook("before_request", set_server_header)
+    app.route("/", callback=index)
+    app.route("/metrics", callback=get_metrics)
+    app.route("/broker", method=["POST"], callback=broker)
+    app.route("/sessions", method=["POST"], callback=register_session)
+    app.route("/sessions/<session_id>", method=["DELETE"], callback=unregister_session)
+    app.route("/wv/<session_id>/license", method=["POST"], callback=license)
+    return app
+
+
 class WebServerThread(threading.Thread):
-    def __init__(self, httpd: WSGIServer, port: int, teardown_url: str) -> None:
+    def __init__(self, httpd: WSGIServer, port: int) -> None:
         threading.Thread.__init__(self)
         self.web_killed = threading.Event()
+        # the playback monitor and the plugin may both stop the server
+        self.stop_lock = threading.Lock()
         self.httpd = httpd
         self.port = port
-        self.teardown_url = teardown_url
+        # only the persistent server has one, see run_persistent_server
+        self.reaper = None
+        # written to on stop, so the select below returns right away
+        self.wakeup_reader, self.wakeup_writer = socket.socketpair()
 
     def run(self) -> None:
         """
         Starts the web server and handles requests until a stop signal is received.
+        Blocks on the listening socket without a timeout, there is no polling.
 
         :return: None
         """
-        while not self.web_killed.is_set():
-            self.httpd.handle_request()
+        with selectors.DefaultSelector() as selector:
+            selector.register(self.httpd, selectors.EVENT_READ)
+            selector.register(self.wakeup_reader, selectors.EVENT_READ)
+            while not self.web_killed.is_set():
+                for key, _ in selector.select():
+                    if key.fileobj is self.httpd and not self.web_killed.is_set():
+                        self.httpd._handle_request_noblock()
+        self.httpd.server_close()
+        self.wakeup_reader.close()
+        self.wakeup_writer.close()
+        # NOTE: make sure every session ends, even if Kodi is shutting down
+        teardown_worker = self.httpd.app.config["teardown_worker"]
+        teardown_worker.stop()
+        teardown_worker.join(
+            teardown_worker.drain_timeout * max(1, teardown_worker.queue.qsize())
+        )
 
     def stop(self) -> None:
         """
-        Stops the web server and sends a teardown call to the provider.
-        Use this method to stop the web server!
+        Stops the web server and queues a teardown call for every session
+         that is still registered. Use this method to stop the web server!
+        Joining the thread waits (for a bounded time) until those are sent.
 
         :return: None
         """
-        if not self.web_killed.is_set():
-            self.send_teardown()
-        self.web_killed.set()
-
-    def send_teardown(self) -> None:
-        """
-        The provider requires a teardown call which is used to tell the
-         provider that the playback session has ended. If we don't send this,
-         the provider won't let us keep more than 2 concurrent sessions every
-         5 minutes.
+        with self.stop_lock:
+            if self.web_killed.is_set():
+                return
+            if self.reaper:
+                self.reaper.stop()
+            app_config = self.httpd.app.config
+            sessions = app_config["sessions"]
+            while True:
+                try:
+                    session_id, license_session = sessions.popitem()
+                except KeyError:
+                    # NOTE: the reaper may have popped the last one meanwhile
+                    break
+                app_config["teardown_worker"].submit(license_session)
+                log_session_summary(app_config, session_id, license_session)
+            self.web_killed.set()
+            self.wakeup_writer.send(b"\0")
+
+
+def _make_server(address: str, port: int, app: Bottle) -> WSGIServer:
+    """
+    Helper, that creates the web server, returns None if the port is in use.
 
-        :return: None
-        """
-        app_config = self.httpd.app.config
-        session_token = app_config["session_token"]
-        headers = {"Nv-Authorizations": session_token}
-        xbmc.log(
-            f"Sending teardown call to {self.teardown_url} with headers {headers}",
-            xbmc.LOGDEBUG,
+    :param address: The address to bind to.
+    :param port: The port to bind to, 0 lets the OS pick one.
+    :param app: The application to serve.
+    :return: The web server or None.
+    """
+    try:
+        return make_server(
+            address,
+            port,
+            app,
+            server_class=ThreadedWSGIServer,
+            handler_class=SilentWSGIRequestHandler,
         )
-        try:
-            response = requests.post(self.teardown_url, json={}, headers=headers)
-            response.raise_for_status()
-        except requests.RequestException:
-            xbmc.log(f"Teardown call failed: {format_exc()}", xbmc.LOGERROR)
-        xbmc.log(f"Teardown call response: {response.text}", xbmc.LOGDEBUG)
+    except OSError as e:
+        # NOTE: Windows reports ports reserved by the system as EACCES
+        if e.errno in (errno.EADDRINUSE, errno.EACCES):
+            return
+        raise
 
 
-def main_service(
-    addon: xbmcaddon.Addon,
-    license_url: str,
-    renewal_url: str,
-    session_token: str,
-    teardown_url: str,
-) -> WebServerThread:
+def _bind(address: str, minport: int, maxport: int, app: Bottle) -> WSGIServer:
+    """
+    Helper, that binds the web server to a port in the allowed range.
+    First asks the OS for an ephemeral port, which is a single syscall.
+     If that one is outside of the range, the range is scanned in order.
+
+    :param address: The address to bind to.
+    :param minport: The lowest allowed port.
+    :param maxport: The highest allowed port.
+    :param app: The application to serve.
+    :return: The web server or None if every port is in use.
     """
-    Main service method that handles the creation of a license proxy
-     thread. Does port selection and starts the web server.
-    Call this method to start the web server.
+    httpd = _make_server(address, 0, app)
+    if httpd:
+        if minport <= httpd.server_port <= maxport:
+            return httpd
+        httpd.server_close()
+    for port in range(minport, maxport + 1):
+        httpd = _make_server(address, port, app)
+        if httpd:
+            return httpd
+
+
+def start_server(addon: xbmcaddon.Addon) -> WebServerThread:
+    """
+    Does port selection and starts the web server without any sessions.
 
     :param addon: The addon instance.
-    :param license_url: The license URL to proxy.
-    :param renewal_url: The renewal URL to proxy.
-    :param session_token: The session token to use.
-    :param teardown_url: The teardown URL to use.
-
     :return: The web server thread.
+    :raises OSError: If no port could be bound.
     """
     name = f"{addon.getAddonInfo('name')} v{addon.getAddonInfo('version')}"
     name = normalize("NFKD", name).encode("ascii", "ignore").decode("ascii")
     handle = f"[{name}]"
-    app = default_app()
-    welcome_text = f"{name} Web Service"
-    app.config["name"] = name
-    app.config["welcome_text"] = welcome_text
-    app.config["license_url"] = license_url
-    app.config["renewal_url"] = renewal_url
-    app.config["session_token"] = session_token
-    app.config["session"] = prepare_session()
+    app = create_app(name)
     minport = addon.getSettingInt("minport")
     maxport = addon.getSettingInt("maxport")
     if minport > maxport or minport < 1024 or maxport > 65535:
         raise ValueError("Invalid port range")
-    tries = 0
-    while tries < 10:
-        port = randint(minport, maxport)
-        xbmc.log(f"{handle} Trying port {port} ({tries})...", xbmc.LOGINFO)
-        try:
-            httpd = make_server(
-                addon.getSetting("webaddress"),
-                port,
-                app,
-                server_class=ThreadedWSGIServer,
-                handler_class=SilentWSGIRequestHandler,
-            )
-            break
-        except OSError as e:
-            if e.errno == 98:
-                tries += 1
-                xbmc.log(
-                    f"{handle} Web service: port {port} already in use",
-                    xbmc.LOGERROR,
-                )
-                return
-            raise
-    if tries == 10:
+    start = perf_counter()
+    httpd = _bind(addon.getSetting("webaddress"), minport, maxport, app)
+    if not httpd:
         xbmc.log(f"{handle} Web service: no available ports", xbmc.LOGERROR)
         raise OSError("No available ports")
+    port = httpd.server_port
 
     httpd.app = app
-    xbmc.log(f"{handle} Web service starting", xbmc.LOGINFO)
-    web_thread = WebServerThread(httpd, port, teardown_url)
+    app.config["teardown_worker"].start()
+    xbmc.log(
+        f"{handle} Web service starting on port {port}, bound in {int((perf_counter() - start) * 1000)} ms",
+        xbmc.LOGINFO,
+    )
+    web_thread = WebServerThread(httpd, port)
     web_thread.start()
     return web_thread
 
 
+def run_persistent_server(addon: xbmcaddon.Addon) -> WebServerThread:
+    """
+    Starts the long-lived web server of the background service and
+     publishes its port, so plugin invocations can register sessions on it.
+
+    :param addon: The addon instance.
+    :return: The web server thread or None if it couldn't be started.
+    """
+    web_thread = start_server(addon)
+    if web_thread:
+        # sessions of crashed plugin processes would stay registered forever
+        web_thread.reaper = SessionReaper(web_thread.httpd.app.config)
+        web_thread.reaper.start()
+        xbmcgui.Window(static.HOME_ID).setProperty(PORT_PROPERTY, str(web_thread.port))
+    return web_thread
+
+
+def main_service(
+    addon: xbmcaddon.Addon,
+    license_url: str,
+    renewal_url: str,
+    session_token: str,
+    teardown_url: str,
+) -> WebServerThread:
+    """
+    Fallback for when the background service is not running: starts
+     a web server with a single session just for one playback.
+    The license route of the session is stored in license_path.
+
+    :param addon: The addon instance.
+    :param license_url: The license URL to proxy.
+    :param renewal_url: The renewal URL to proxy.
+    :param session_token: The session token to use.
+    :param teardown_url: The teardown URL to use.
+
+    :return: The web server thread.
+    """
+    web_thread = start_server(addon)
+    if not web_thread:
+        return
+    session_id = uuid4().hex
+    web_thread.httpd.app.config["sessions"][session_id] = LicenseSession(
+        license_url, renewal_url, session_token, teardown_url
+    )
+    preconnect(web_thread.httpd.app.config["session"], [license_url])
+    web_thread.license_path = f"/wv/{session_id}/license"
+    return web_thread
+
+
 if __name__ == "__main__":
     monitor = xbmc.Monitor()
     addon = xbmcaddon.Addon()
-    web_thread = main_service(addon)
+    web_thread = run_persistent_server(addon)
 
     while not monitor.abortRequested():
         if monitor.waitForAbort(1):
             break
     if web_thread and web_thread.is_alive():
+        xbmcgui.Window(static.HOME_ID).clearProperty(PORT_PROPERTY)
         web_thread.stop()
         try:
             web_thread.join()
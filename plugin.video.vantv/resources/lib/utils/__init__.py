@@ -1,12 +1,19 @@
+from base64 import urlsafe_b64decode
 from datetime import datetime, timezone
+from json import loads
 from os import environ
 from random import choice
+from threading import Thread
+from typing import Iterable
+from urllib.parse import urlparse
 
 import xbmc
-from requests import Session
+from requests import Request, Session
 from resources.lib.utils import static as utils_static
+from resources.lib.utils.http import create_session
 from resources.lib.van import static
 from xbmcaddon import Addon
+from xbmcvfs import translatePath
 
 addon = Addon()
 
@@ -40,6 +47,22 @@ def unix_to_epg_time(unix_time: int):
     )
 
 
+def get_jwt_expiry(token: str) -> int:
+    """
+    Get the expiry of a JWT. The signature is not verified, we only
+     use this to know how long a token can be reused.
+
+    :param token: The token.
+    :return: The exp claim in unix time or None if the token is not a JWT.
+    """
+    try:
+        payload = token.split(".")[1]
+        payload += "=" * (-len(payload) % 4)
+        return int(loads(urlsafe_b64decode(payload))["exp"])
+    except (IndexError, KeyError, TypeError, ValueError):
+        return None
+
+
 def get_kodi_version() -> int:
     """
     Get the Kodi major version number.
@@ -58,10 +81,23 @@ def is_android() -> bool:
     return xbmc.getInfoLabel("System.Platform.Android") or "ANDROID_STORAGE" in environ
 
 
+def get_profile_path(name: str) -> str:
+    """
+    Get the local path of a file or directory in the addon's profile folder.
+
+    :param name: The name of the file or directory.
+    :return: The translated path.
+    """
+    return translatePath(
+        f"special://profile/addon_data/{addon.getAddonInfo('id')}/{name}"
+    )
+
+
 def prepare_session() -> Session:
     """
     Prepare a requests session for use within the addon. Also sets
      the user agent to a random desktop user agent if it is not set.
+    Pools, timeouts and retries are set up by the session factory.
 
     :return: The prepared session.
     """
@@ -72,13 +108,38 @@ def prepare_session() -> Session:
         else:
             addon.setSetting("useragent", choice(utils_static.desktop_user_agents))
         user_agent = addon.getSetting("useragent")
-    session = Session()
-    session.headers.update(
-        {
-            "User-Agent": user_agent,
-        }
-    )
-    return session
+    return create_session({"User-Agent": user_agent}, addon)
+
+
+def preconnect(session: Session, urls: Iterable[str], timeout: float = 5) -> None:
+    """
+    Opens connections to the hosts of the given URLs in parallel, in the background.
+    The connections stay in the pool of the session, so later requests to
+     those hosts skip the DNS lookup and the TCP and TLS handshakes.
+    Errors are ignored, this is only an optimization. The requests are marked
+     with a preconnect attribute, so the response hooks can tell them apart.
+
+    :param session: The requests session to warm up.
+    :param urls: URLs of the hosts, only their origins are contacted.
+    :param timeout: The timeout of the requests in seconds.
+    :return: None
+    """
+
+    def connect(origin: str) -> None:
+        try:
+            prepared = session.prepare_request(Request("HEAD", origin))
+            prepared.preconnect = True
+            session.send(prepared, timeout=timeout, allow_redirects=False).close()
+        except Exception:
+            xbmc.log(f"Pre-connecting to {origin} failed", xbmc.LOGDEBUG)
+
+    origins = set()
+    for url in urls:
+        parsed = urlparse(url)
+        if parsed.scheme and parsed.netloc:
+            origins.add(f"{parsed.scheme}://{parsed.netloc}/")
+    for origin in origins:
+        Thread(target=connect, args=(origin,), daemon=True).start()
 
 
 def prepare_device() -> None:
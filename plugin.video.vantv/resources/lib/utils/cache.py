@@ -0,0 +1,99 @@
+import os
+from hashlib import sha1
+from json import dump, load
+from time import time
+from typing import Any, Tuple
+from uuid import uuid4
+
+
+class ResponseCache:
+    """
+    Small disk-backed key-value cache for JSON serializable values.
+    Shared by all plugin invocations and the service, so data fetched by one
+     process can be reused by the next one.
+
+    Every key is stored in its own file, writes are atomic. The total size
+     of the cache is bounded, least recently stored entries are evicted first.
+    """
+
+    def __init__(self, path: str, max_bytes: int = 5 * 1024 * 1024) -> None:
+        self.path = path
+        self.max_bytes = max_bytes
+        os.makedirs(self.path, exist_ok=True)
+
+    def _entry_path(self, key: str) -> str:
+        return os.path.join(self.path, f"{sha1(key.encode('utf-8')).hexdigest()}.json")
+
+    def get(self, key: str) -> Tuple[Any, float]:
+        """
+        Get a value from the cache.
+
+        :param key: The key of the entry.
+        :return: Tuple of the value and the unix time it was stored. (None, 0) on miss.
+        """
+        try:
+            with open(self._entry_path(key), "r", encoding="utf-8") as f:
+                entry = load(f)
+        except (OSError, ValueError):
+            return None, 0
+        if entry.get("key") != key:
+            return None, 0
+        return entry.get("value"), entry.get("stored", 0)
+
+    def set(self, key: str, value: Any) -> None:
+        """
+        Store a value in the cache and evict old entries if the cache is full.
+
+        :param key: The key of the entry.
+        :param value: The JSON serializable value.
+        :return: None
+        """
+        path = self._entry_path(key)
+        # NOTE: Kodi runs the service and the plugin in one process, the PID isn't unique
+        temp_path = f"{path}.{uuid4().hex}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            dump(
+                {"key": key, "stored": time(), "value": value},
+                f,
+                separators=(",", ":"),
+            )
+        os.replace(temp_path, path)
+        self._evict()
+
+    def delete(self, key: str) -> None:
+        """
+        Remove an entry from the cache.
+
+        :param key: The key of the entry.
+        :return: None
+        """
+        try:
+            os.remove(self._entry_path(key))
+        except OSError:
+            pass
+
+    def _evict(self) -> None:
+        """
+        Remove the oldest entries until the cache fits into max_bytes.
+
+        :return: None
+        """
+        entries = []
+        total = 0
+        for name in os.listdir(self.path):
+            if not name.endswith(".json"):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.path, name))
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+            total += stat.st_size
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.path, name))
+            except OSError:
+                continue
+            total -= size
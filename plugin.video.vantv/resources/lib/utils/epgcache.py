@@ -0,0 +1,101 @@
+import os
+from json import dump, load
+from shutil import rmtree
+from urllib.parse import quote
+from uuid import uuid4
+
+
+class EPGCache:
+    """
+    On-disk cache of EPG responses, keyed by channel ID and day bucket.
+    A day bucket is the number of whole days since the unix epoch (UTC).
+
+    Every (channel, day) pair is stored in its own file, so a refresh can
+    replace only the days that changed while the rest is served from disk.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        os.makedirs(self.path, exist_ok=True)
+
+    def _day_path(self, day: int) -> str:
+        return os.path.join(self.path, str(day))
+
+    def _entry_path(self, channel_id: str, day: int) -> str:
+        return os.path.join(self._day_path(day), f"{quote(channel_id, safe='')}.json")
+
+    def stored_at(self, channel_id: str, day: int) -> float:
+        """
+        Get the time the entry was last stored.
+
+        :param channel_id: The channel ID.
+        :param day: The day bucket.
+
+        :return: The unix time of the last store, 0 if there is no entry.
+        """
+        try:
+            return os.path.getmtime(self._entry_path(channel_id, day))
+        except OSError:
+            return 0
+
+    def is_empty(self, channel_id: str, day: int) -> bool:
+        """
+        Check if the entry has no programmes, without loading it.
+
+        :param channel_id: The channel ID.
+        :param day: The day bucket.
+
+        :return: True if there is no entry or it's an empty list.
+        """
+        try:
+            # an empty list is stored as "[]"
+            return os.path.getsize(self._entry_path(channel_id, day)) <= 2
+        except OSError:
+            return True
+
+    def load(self, channel_id: str, day: int) -> list:
+        """
+        Load the programmes of a channel for a given day.
+
+        :param channel_id: The channel ID.
+        :param day: The day bucket.
+
+        :return: The list of programmes, empty if there is no (valid) entry.
+        """
+        try:
+            with open(self._entry_path(channel_id, day), "r", encoding="utf-8") as f:
+                return load(f)
+        except (OSError, ValueError):
+            return []
+
+    def store(self, channel_id: str, day: int, programmes: list) -> None:
+        """
+        Store the programmes of a channel for a given day. The entry is
+         replaced atomically, so concurrent readers never see partial data.
+
+        :param channel_id: The channel ID.
+        :param day: The day bucket.
+        :param programmes: The list of programmes in the provider's JSON format.
+
+        :return: None
+        """
+        os.makedirs(self._day_path(day), exist_ok=True)
+        path = self._entry_path(channel_id, day)
+        # NOTE: Kodi runs the service and the plugin in one process, the PID isn't unique
+        temp_path = f"{path}.{uuid4().hex}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            dump(programmes, f, separators=(",", ":"))
+        os.replace(temp_path, path)
+
+    def prune(self, first_day: int, last_day: int) -> None:
+        """
+        Remove every day bucket outside of the given range (inclusive).
+
+        :param first_day: The first day bucket to keep.
+        :param last_day: The last day bucket to keep.
+
+        :return: None
+        """
+        for name in os.listdir(self.path):
+            if not name.isdigit() or not first_day <= int(name) <= last_day:
+                rmtree(os.path.join(self.path, name), ignore_errors=True)
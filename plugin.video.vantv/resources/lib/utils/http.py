@@ -0,0 +1,98 @@
+from random import uniform
+
+from requests import PreparedRequest, Response, Session
+from requests.adapters import HTTPAdapter
+from requests.utils import DEFAULT_ACCEPT_ENCODING
+from urllib3.util.retry import Retry
+from xbmcaddon import Addon
+
+"""
+Central factory of the requests sessions talking to the providers.
+
+The default adapter of requests has no timeout, no retries and a pool of
+ 10 connections per host. A hung socket could freeze a background thread
+ forever, and a single reset connection failed the whole EPG update.
+"""
+
+# statuses worth retrying, the request most likely never reached the application
+RETRY_STATUSES = (502, 503, 504)
+
+
+class JitterRetry(Retry):
+    """Retry policy with full jitter, so concurrent workers don't retry in lockstep"""
+
+    def get_backoff_time(self) -> float:
+        return uniform(0, super().get_backoff_time())
+
+
+class TimeoutHTTPAdapter(HTTPAdapter):
+    """HTTP adapter that applies a default timeout to requests without one"""
+
+    def __init__(self, *args, timeout: tuple = None, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.timeout = timeout
+
+    def send(self, request: PreparedRequest, **kwargs) -> Response:
+        if kwargs.get("timeout") is None:
+            kwargs["timeout"] = self.timeout
+        return super().send(request, **kwargs)
+
+
+def get_adapter_options(addon: Addon = None) -> dict:
+    """
+    Get the adapter options configured in the settings.
+
+    :param addon: The addon instance, a new one is created if not given.
+    :return: Keyword arguments for TimeoutHTTPAdapter.
+    """
+    addon = addon or Addon()
+    # NOTE: the EPG workers share one session, each of them needs a connection
+    pool_size = max(
+        addon.getSettingInt("httppoolsize"), addon.getSettingInt("epgworkers"), 1
+    )
+    retries = JitterRetry(
+        total=max(addon.getSettingInt("httpretries"), 0),
+        # NOTE: only idempotent methods are retried after the request was sent,
+        # connection errors are retried for every method as nothing was sent yet
+        allowed_methods=Retry.DEFAULT_ALLOWED_METHODS,
+        status_forcelist=RETRY_STATUSES,
+        backoff_factor=0.5,
+        # the callers check the status themselves with raise_for_status
+        raise_on_status=False,
+    )
+    return {
+        "pool_connections": pool_size,
+        "pool_maxsize": pool_size,
+        "max_retries": retries,
+        "timeout": (
+            max(addon.getSettingInt("httpconnecttimeout"), 1),
+            max(addon.getSettingInt("httpreadtimeout"), 1),
+        ),
+    }
+
+
+def create_session(headers: dict = None, addon: Addon = None) -> Session:
+    """
+    Create a requests session with tuned connection pools, timeouts and retries.
+    Routes mounted later on more specific prefixes (like the API broker) still
+     take precedence over these adapters.
+
+    :param headers: Extra headers to send with every request.
+    :param addon: The addon instance, a new one is created if not given.
+    :return: The session.
+    """
+    addon = addon or Addon()
+    session = Session()
+    adapter = TimeoutHTTPAdapter(**get_adapter_options(addon))
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    # br is only offered if a brotli decoder is installed
+    session.headers["Accept-Encoding"] = DEFAULT_ACCEPT_ENCODING
+    if headers:
+        session.headers.update(headers)
+    if addon.getSettingBool("perfstats"):
+        # NOTE: imported here, perfstats depends on the utils package that imports us
+        from resources.lib.utils.perfstats import record_response
+
+        session.hooks["response"].append(record_response)
+    return session
@@ -0,0 +1,164 @@
+from codecs import getincrementaldecoder
+from json import JSONDecodeError, JSONDecoder
+from typing import Iterator
+
+from requests import Response
+
+"""
+Minimal incremental JSON parser for large provider responses.
+
+Instead of decoding the whole body, we only walk the top level object
+ and decode the items of a single array one by one. Each value is still
+ decoded by the C accelerated json decoder, so parsing stays fast while
+ the memory usage is bounded by the largest single item.
+"""
+
+_decoder = JSONDecoder()
+_whitespace = " \t\n\r"
+# characters a number can continue with
+_number_chars = "0123456789+-.eE"
+
+
+class _Reader:
+    """Buffered reader that decodes JSON values from a stream of byte chunks"""
+
+    def __init__(self, chunks: Iterator[bytes]) -> None:
+        self.chunks = chunks
+        self.text_decoder = getincrementaldecoder("utf-8")()
+        self.buffer = ""
+        self.pos = 0
+        self.exhausted = False
+
+    def fill(self) -> bool:
+        """
+        Reads the next chunk into the buffer and drops the consumed part.
+
+        :return: False if the stream is exhausted, True otherwise.
+        """
+        if self.exhausted:
+            return False
+        chunk = next(self.chunks, None)
+        if chunk is None:
+            self.exhausted = True
+            self.buffer = self.buffer[self.pos :] + self.text_decoder.decode(
+                b"", final=True
+            )
+        else:
+            self.buffer = self.buffer[self.pos :] + self.text_decoder.decode(chunk)
+        self.pos = 0
+        return not self.exhausted
+
+    def peek(self) -> str:
+        """
+        Skips whitespace and returns the next character without consuming it.
+
+        :return: The next character or an empty string at the end of the stream.
+        """
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in _whitespace:
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self.fill():
+                return ""
+
+    def take(self, expected: str) -> str:
+        """
+        Consumes the next character and checks it against the expected ones.
+
+        :param expected: The allowed characters.
+        :return: The consumed character.
+        :raises ValueError: If the next character is not allowed.
+        """
+        char = self.peek()
+        if not char or char not in expected:
+            raise ValueError(f"Expected one of {expected!r}, got {char!r}")
+        self.pos += 1
+        return char
+
+    def value(self):
+        """
+        Decodes the next JSON value, reading more chunks as necessary.
+
+        :return: The decoded value.
+        """
+        self.peek()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self.buffer, self.pos)
+            except JSONDecodeError:
+                if self.fill():
+                    continue
+                raise
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                # NOTE: a number cut by the chunk boundary is decoded as a shorter
+                # number (1.|5 as 1), so it's only complete if something else follows
+                rest = end
+                while rest < len(self.buffer) and self.buffer[rest] in _number_chars:
+                    rest += 1
+                if rest == len(self.buffer) and self.fill():
+                    continue
+            self.pos = end
+            return value
+
+
+def iter_array(chunks: Iterator[bytes], key: str) -> Iterator:
+    """
+    Yields the items of an array under the given key of the top level JSON object.
+
+    :param chunks: The body as an iterator of byte chunks.
+    :param key: The key of the array in the top level object.
+    :return: Iterator of the decoded array items.
+    :raises ValueError: If the body is not valid JSON.
+    """
+    reader = _Reader(iter(chunks))
+    reader.take("{")
+    if reader.peek() == "}":
+        return
+    while True:
+        name = reader.value()
+        reader.take(":")
+        if name == key and reader.peek() == "[":
+            reader.take("[")
+            if reader.peek() == "]":
+                return
+            while True:
+                yield reader.value()
+                if reader.take(",]") == "]":
+                    # we are not interested in the rest of the object
+                    return
+        # skip values we are not interested in
+        reader.value()
+        if reader.take(",}") == "}":
+            return
+
+
+def iter_response_array(
+    response: Response, key: str, chunk_size: int = 65536
+) -> Iterator:
+    """
+    Yields the items of an array under the given key of a streamed JSON response.
+    The status is checked before returning, so HTTP errors are raised on the call
+     and not on the first iteration. The response is closed once the iterator is done.
+
+    :param response: The response of a request made with stream=True.
+    :param key: The key of the array in the top level object.
+    :param chunk_size: The size of the chunks read from the network.
+    :return: Iterator of the decoded array items.
+    :raises HTTPError: If the response has an error status.
+    """
+    if not response.ok:
+        try:
+            # read the body, so error handlers can still access it
+            response.content
+        finally:
+            response.close()
+        response.raise_for_status()
+
+    def items() -> Iterator:
+        try:
+            yield from iter_array(response.iter_content(chunk_size), key)
+        finally:
+            response.close()
+
+    return items()
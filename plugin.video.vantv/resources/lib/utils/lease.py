@@ -0,0 +1,80 @@
+import os
+from time import sleep, time
+
+
+class FileLease:
+    """
+    Cross-process lock based on exclusively creating a lock file.
+    Works between plugin invocations and the service threads alike.
+
+    The lease is considered stale after stale_after seconds, so a process
+     that was killed while holding it can't block the others forever.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        timeout: float = 30,
+        stale_after: float = 60,
+        poll_interval: float = 0.1,
+    ) -> None:
+        self.path = path
+        self.timeout = timeout
+        self.stale_after = stale_after
+        self.poll_interval = poll_interval
+        self.acquired = False
+
+    def acquire(self) -> bool:
+        """
+        Try to acquire the lease, waiting at most timeout seconds.
+
+        :return: True if the lease was acquired, False on timeout.
+        """
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        deadline = time() + self.timeout
+        while True:
+            try:
+                fd = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                self._break_stale()
+            else:
+                with os.fdopen(fd, "w") as f:
+                    f.write(str(os.getpid()))
+                self.acquired = True
+                return True
+            if time() >= deadline:
+                return False
+            sleep(self.poll_interval)
+
+    def release(self) -> None:
+        """
+        Release the lease if we hold it.
+
+        :return: None
+        """
+        if not self.acquired:
+            return
+        self.acquired = False
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+    def _break_stale(self) -> None:
+        """
+        Remove the lock file if its holder didn't release it in time.
+
+        :return: None
+        """
+        try:
+            if time() - os.path.getmtime(self.path) > self.stale_after:
+                os.remove(self.path)
+        except OSError:
+            # released (or broken) by someone else meanwhile
+            pass
+
+    def __enter__(self) -> bool:
+        return self.acquire()
+
+    def __exit__(self, *args) -> None:
+        self.release()
@@ -0,0 +1,184 @@
+import os
+from json import dump, load
+from time import time
+from typing import Callable, Dict, List, Tuple
+
+from resources.lib.utils import get_profile_path
+from resources.lib.utils.lease import FileLease
+
+"""
+Cross-process ledger of the DRM sessions set up by the addon.
+
+The provider only allows a few concurrent SSM sessions. A session leaked
+ by a crashed plugin process keeps occupying a slot until it times out,
+ so every session is recorded here until its teardown succeeds. The process
+ playing a session updates its heartbeat; sessions that are neither ended
+ nor heartbeated for a while are orphans and can be torn down by anyone.
+
+Entries are keyed by the first session token, renewals update the token
+ that's used for the teardown.
+"""
+
+# states of the recorded sessions
+ACTIVE = "active"
+ORPHANED = "orphaned"
+ENDED = "ended"
+
+
+class SessionLedger:
+    """Small JSON file of DRM sessions, guarded by a file lease"""
+
+    def __init__(
+        self, path: str, heartbeat_timeout: int = 90, keep_ended: int = 300
+    ) -> None:
+        self.path = path
+        self.heartbeat_timeout = heartbeat_timeout
+        self.keep_ended = keep_ended
+
+    def _load(self) -> dict:
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                return load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save(self, entries: dict) -> None:
+        temp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            dump(entries, f, separators=(",", ":"))
+        os.replace(temp_path, self.path)
+
+    def _update(self, func: Callable):
+        """
+        Loads the entries, applies func on them and saves them, all under the lease.
+        Ended entries older than keep_ended are dropped on the way.
+
+        :param func: Function that modifies the entries in place.
+        :return: The return value of func.
+        """
+        # NOTE: on timeout we go ahead anyway, a lost update is better than a stuck playback
+        with FileLease(f"{self.path}.lock", timeout=5):
+            entries = self._load()
+            result = func(entries)
+            now = time()
+            for key in [
+                key
+                for key, entry in entries.items()
+                if entry.get("ended") and now - entry["ended"] > self.keep_ended
+            ]:
+                del entries[key]
+            self._save(entries)
+            return result
+
+    def add(self, session_token: str) -> None:
+        """
+        Records a new DRM session.
+
+        :param session_token: The session token returned by the session setup.
+        :return: None
+        """
+        now = time()
+
+        def add(entries: dict) -> None:
+            entries[session_token] = {
+                "token": session_token,
+                "created": now,
+                "seen": now,
+                "ended": None,
+            }
+
+        self._update(add)
+
+    def touch(self, key: str, session_token: str = None) -> None:
+        """
+        Updates the heartbeat of a session and optionally its current token.
+        The entry is recreated if it's missing (e.g. its add was lost).
+
+        :param key: The first session token of the session.
+        :param session_token: The renewed session token, if any.
+        :return: None
+        """
+
+        def touch(entries: dict) -> None:
+            now = time()
+            entry = entries.setdefault(
+                key, {"token": key, "created": now, "seen": now, "ended": None}
+            )
+            entry["seen"] = now
+            if session_token:
+                entry["token"] = session_token
+
+        self._update(touch)
+
+    def mark_ended(self, key: str) -> None:
+        """
+        Marks a session as successfully torn down.
+
+        :param key: The first session token of the session.
+        :return: None
+        """
+
+        def mark_ended(entries: dict) -> None:
+            entry = entries.get(key)
+            if entry:
+                entry["ended"] = time()
+
+        self._update(mark_ended)
+
+    def take_orphans(self) -> List[Tuple[str, str]]:
+        """
+        Collects the sessions whose owner is gone. Their heartbeat is refreshed,
+         so concurrent callers don't tear down the same sessions.
+
+        :return: List of (key, current session token) pairs.
+        """
+
+        def take_orphans(entries: dict) -> list:
+            now = time()
+            orphans = []
+            for key, entry in entries.items():
+                if entry.get("ended") or now - entry["seen"] < self.heartbeat_timeout:
+                    continue
+                entry["seen"] = now
+                orphans.append((key, entry["token"]))
+            return orphans
+
+        return self._update(take_orphans)
+
+    def states(self) -> Dict[str, str]:
+        """
+        Classifies every recorded session, without claiming the orphans.
+
+        :return: Dict of the session keys to ACTIVE, ORPHANED or ENDED.
+        """
+        now = time()
+        states = {}
+        for key, entry in self._load().items():
+            if entry.get("ended"):
+                states[key] = ENDED
+            elif now - entry["seen"] < self.heartbeat_timeout:
+                states[key] = ACTIVE
+            else:
+                states[key] = ORPHANED
+        return states
+
+    def has_recent(self) -> bool:
+        """
+        Checks if any of our sessions might still occupy a slot on the provider's side.
+
+        :return: True if there is an active or a recently ended session.
+        """
+        now = time()
+        return any(
+            not entry.get("ended") or now - entry["ended"] < self.keep_ended
+            for entry in self._load().values()
+        )
+
+
+def get_session_ledger() -> SessionLedger:
+    """
+    Get the session ledger of the addon's profile.
+
+    :return: The session ledger.
+    """
+    return SessionLedger(get_profile_path("drmsessions.json"))
@@ -0,0 +1,262 @@
+from traceback import format_exc
+from urllib.parse import urlparse
+
+import requests
+import xbmc
+import xbmcgui
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+from resources.lib.utils.http import TimeoutHTTPAdapter, get_adapter_options
+from resources.lib.van import static
+from urllib3.exceptions import NewConnectionError
+
+"""
+Client side of the persistent license proxy that runs in the background service.
+
+Kept separate from licproxy_service, so plugin invocations can register
+ their playback sessions without importing the web server (and bottle).
+
+The same server also works as an API broker: plugin invocations forward their
+ provider requests to it over loopback, and it sends them through its pooled
+ session. That way the DNS, TCP and TLS handshakes are only paid once by the
+ service instead of by every click.
+"""
+
+PORT_PROPERTY = "kodi.van.licproxy_port"
+# headers of the broker protocol, never forwarded to the provider
+BROKER_METHOD_HEADER = "X-Broker-Method"
+BROKER_URL_HEADER = "X-Broker-Url"
+BROKER_MARK_HEADER = "X-Broker"
+# sent with the connection warm-ups of preconnect, that aren't worth recording
+BROKER_PRECONNECT_HEADER = "X-Broker-Preconnect"
+# the connect and read timeouts of the plugin's request, e.g. "5,30"
+BROKER_TIMEOUT_HEADER = "X-Broker-Timeout"
+
+
+def get_broker_hosts() -> set:
+    """
+    Get the hosts the broker is allowed to forward requests to.
+
+    :return: The set of host names.
+    """
+    return {
+        urlparse(base).netloc
+        for base in (
+            static.get_api_base(),
+            static.get_imageservice_base(),
+            static.get_license_server_base(),
+        )
+    }
+
+
+class BrokerAdapter(TimeoutHTTPAdapter):
+    """
+    Transport adapter that sends the requests through the broker of the service.
+    Falls back to a direct connection only if the request never left the plugin:
+     the broker is not reachable or refuses the host. Any other failure is
+     passed on, as the request may have reached the provider already.
+    """
+
+    def __init__(self, port: int, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.port = port
+        self.loopback = requests.Session()
+
+    def send(self, request: requests.PreparedRequest, **kwargs) -> requests.Response:
+        headers = dict(request.headers)
+        headers[BROKER_METHOD_HEADER] = request.method
+        headers[BROKER_URL_HEADER] = request.url
+        if getattr(request, "preconnect", False):
+            headers[BROKER_PRECONNECT_HEADER] = "1"
+        connect_timeout, read_timeout = _split_timeout(
+            kwargs.get("timeout") or self.timeout
+        )
+        # NOTE: the broker uses the same timeouts, so brokered requests fail
+        # at the same time as direct ones
+        headers[BROKER_TIMEOUT_HEADER] = f"{connect_timeout},{read_timeout}"
+        try:
+            brokered = self.loopback.post(
+                f"http://127.0.0.1:{self.port}/broker",
+                data=request.body,
+                headers=headers,
+                # the broker has to connect and wait for the provider first
+                timeout=(connect_timeout, connect_timeout + read_timeout + 1),
+                allow_redirects=False,
+                # NOTE: the body is read by requests unless the caller streams it
+                stream=True,
+            )
+        except requests.ConnectionError as e:
+            if not _is_connect_error(e):
+                # the broker got the request, resending it could duplicate it
+                raise
+            xbmc.log("API broker not reachable, connecting directly", xbmc.LOGDEBUG)
+            return super().send(request, **kwargs)
+        if (
+            brokered.status_code == 403
+            and brokered.headers.get(BROKER_MARK_HEADER) != "1"
+        ):
+            brokered.close()
+            xbmc.log(
+                f"API broker refused {request.url}, connecting directly", xbmc.LOGDEBUG
+            )
+            return super().send(request, **kwargs)
+
+        # NOTE: unmarked responses (like the 502 of a failed upstream request)
+        # are passed on as they are
+        response = requests.Response()
+        response.status_code = brokered.status_code
+        response.reason = brokered.reason
+        response.headers = CaseInsensitiveDict(
+            (key, value)
+            for key, value in brokered.headers.items()
+            if key not in (BROKER_MARK_HEADER, "Server", "Date", "Content-Length")
+        )
+        response.encoding = get_encoding_from_headers(response.headers)
+        response.raw = brokered.raw
+        response.url = request.url
+        response.request = request
+        response.connection = self
+        # the service already recorded the timing of the upstream request
+        response.brokered = True
+        return response
+
+    def close(self) -> None:
+        self.loopback.close()
+        super().close()
+
+
+def _split_timeout(timeout) -> tuple:
+    """
+    Split a timeout of requests into the connect and the read timeout.
+
+    :param timeout: A single timeout or a (connect, read) tuple in seconds.
+    :return: The connect and the read timeout, 60 seconds if not given.
+    """
+    if not isinstance(timeout, tuple):
+        timeout = (timeout, timeout)
+    return tuple(value or 60 for value in timeout)
+
+
+def parse_broker_timeout(value: str):
+    """
+    Parse the timeouts sent by BrokerAdapter.
+
+    :param value: The value of the X-Broker-Timeout header.
+    :return: The (connect, read) tuple, None if missing or invalid.
+    """
+    try:
+        connect_timeout, read_timeout = (float(part) for part in value.split(","))
+    except (AttributeError, ValueError):
+        return None
+    if connect_timeout <= 0 or read_timeout <= 0:
+        return None
+    return connect_timeout, read_timeout
+
+
+def _is_connect_error(error: requests.ConnectionError) -> bool:
+    """
+    Check whether a connection error happened before the request was sent.
+
+    :param error: The error raised by requests.
+    :return: True if the connection couldn't be established.
+    """
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], "reason", None) if error.args else None
+    return isinstance(reason, NewConnectionError)
+
+
+def mount_broker(session: requests.Session) -> None:
+    """
+    Routes the provider requests of the session through the broker of the
+     service, if it's running.
+
+    :param session: The requests session of the plugin invocation.
+    :return: None
+    """
+    port = xbmcgui.Window(static.HOME_ID).getProperty(PORT_PROPERTY)
+    if not port:
+        return
+    # NOTE: the direct fallback uses the same pools, timeouts and retries
+    adapter = BrokerAdapter(int(port), **get_adapter_options())
+    for base in (
+        static.get_api_base(),
+        static.get_imageservice_base(),
+        static.get_license_server_base(),
+    ):
+        session.mount(base, adapter)
+
+
+class ProxySession:
+    """
+    A playback session registered on the persistent license proxy.
+    Mimics the interface of the in-process proxy thread, so play()
+     can handle both the same way.
+    """
+
+    def __init__(self, port: int, session_id: str) -> None:
+        self.port = port
+        self.session_id = session_id
+        self.license_path = f"/wv/{session_id}/license"
+        self.stopped = False
+
+    def is_alive(self) -> bool:
+        """Returns whether the session is still registered"""
+        return not self.stopped
+
+    def stop(self) -> None:
+        """
+        Unregisters the session, the proxy sends the teardown call to the provider.
+
+        :return: None
+        """
+        if self.stopped:
+            return
+        self.stopped = True
+        try:
+            requests.delete(
+                f"http://127.0.0.1:{self.port}/sessions/{self.session_id}", timeout=10
+            ).raise_for_status()
+        except requests.RequestException:
+            xbmc.log(
+                f"Unregistering proxy session failed: {format_exc()}", xbmc.LOGERROR
+            )
+
+    def join(self, timeout: float = None) -> None:
+        """Nothing to wait for, the server is owned by the service"""
+        pass
+
+
+def register_session(
+    license_url: str, renewal_url: str, session_token: str, teardown_url: str
+) -> ProxySession:
+    """
+    Registers a playback session on the persistent license proxy.
+
+    :param license_url: The license URL to proxy.
+    :param renewal_url: The renewal URL to proxy.
+    :param session_token: The session token to use.
+    :param teardown_url: The teardown URL to use.
+
+    :return: The registered session or None if the proxy is not available.
+    """
+    port = xbmcgui.Window(static.HOME_ID).getProperty(PORT_PROPERTY)
+    if not port:
+        return
+    try:
+        response = requests.post(
+            f"http://127.0.0.1:{port}/sessions",
+            json={
+                "license_url": license_url,
+                "renewal_url": renewal_url,
+                "session_token": session_token,
+                "teardown_url": teardown_url,
+            },
+            timeout=5,
+        )
+        response.raise_for_status()
+        session_id = response.json()["id"]
+    except (requests.RequestException, ValueError, KeyError):
+        xbmc.log(f"License proxy not available: {format_exc()}", xbmc.LOGWARNING)
+        return
+    return ProxySession(int(port), session_id)
@@ -0,0 +1,128 @@
+import threading
+from bisect import bisect_left
+from time import time
+from typing import Tuple
+
+# upper bounds of the latency histogram buckets in seconds
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _labels_key(labels: dict) -> Tuple[Tuple[str, str], ...]:
+    return tuple(sorted((key, str(value)) for key, value in (labels or {}).items()))
+
+
+def _format_labels(labels: tuple, extra: tuple = ()) -> str:
+    labels = labels + extra
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+
+class Metrics:
+    """
+    Minimal thread-safe counters, histograms and event timestamps,
+     rendered in the Prometheus text exposition format.
+    """
+
+    def __init__(self, prefix: str, buckets: tuple = LATENCY_BUCKETS) -> None:
+        self.prefix = prefix
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.events = {}
+
+    def inc(self, name: str, labels: dict = None, value: float = 1) -> None:
+        """
+        Increments a counter.
+
+        :param name: The name of the counter, without the prefix.
+        :param labels: The labels of the series.
+        :param value: The amount to add.
+        :return: None
+        """
+        key = (name, _labels_key(labels))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, labels: dict = None) -> None:
+        """
+        Records a value in a histogram.
+
+        :param name: The name of the histogram, without the prefix.
+        :param value: The observed value.
+        :param labels: The labels of the series.
+        :return: None
+        """
+        key = (name, _labels_key(labels))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if not histogram:
+                # bucket counts (the last one is +Inf), sum, count
+                histogram = self.histograms[key] = [[0] * (len(self.buckets) + 1), 0, 0]
+            histogram[0][bisect_left(self.buckets, value)] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    def mark(self, name: str) -> None:
+        """
+        Records the time of an event, exposed as seconds since the last one.
+
+        :param name: The name of the event.
+        :return: None
+        """
+        with self.lock:
+            self.events[name] = time()
+
+    def render(self) -> str:
+        """
+        Renders every metric in the Prometheus text format.
+
+        :return: The metrics as text.
+        """
+        lines = []
+        with self.lock:
+            typed = set()
+            for (name, labels), value in sorted(self.counters.items()):
+                full_name = f"{self.prefix}_{name}"
+                if full_name not in typed:
+                    typed.add(full_name)
+                    lines.append(f"# TYPE {full_name} counter")
+                lines.append(f"{full_name}{_format_labels(labels)} {value}")
+            for (name, labels), (counts, total, count) in sorted(
+                self.histograms.items()
+            ):
+                full_name = f"{self.prefix}_{name}"
+                if full_name not in typed:
+                    typed.add(full_name)
+                    lines.append(f"# TYPE {full_name} histogram")
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets + ("+Inf",), counts):
+                    cumulative += bucket_count
+                    lines.append(
+                        f"{full_name}_bucket{_format_labels(labels, (('le', str(bound)),))} {cumulative}"
+                    )
+                lines.append(f"{full_name}_sum{_format_labels(labels)} {total}")
+                lines.append(f"{full_name}_count{_format_labels(labels)} {count}")
+            now = time()
+            for name, timestamp in sorted(self.events.items()):
+                full_name = f"{self.prefix}_seconds_since_last_{name}"
+                lines.append(f"# TYPE {full_name} gauge")
+                lines.append(f"{full_name} {now - timestamp:.3f}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self) -> str:
+        """
+        Short, human readable summary for the log.
+
+        :return: The summary.
+        """
+        parts = []
+        with self.lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                parts.append(f"{name}{_format_labels(labels)}={value}")
+            for (name, labels), (_, total, count) in sorted(self.histograms.items()):
+                parts.append(
+                    f"{name}{_format_labels(labels)}: avg {total / count:.3f}s of {count}"
+                )
+        return ", ".join(parts)
@@ -0,0 +1,214 @@
+import os
+import re
+import threading
+from json import dumps, loads
+from math import ceil
+from time import time
+from typing import Dict, List
+from urllib.parse import urlparse
+
+from requests import Response
+from resources.lib.utils import get_profile_path
+from resources.lib.utils.lease import FileLease
+
+"""
+Rolling on-disk log of the provider requests' timings.
+
+Every process (plugin invocations and the service alike) appends one JSON
+ line per response to the same file, which is trimmed to its newer half once
+ it grows too big. Requests sent through the API broker are only recorded
+ by the service, so the timings show the provider's latency without the
+ loopback hop and nothing is counted twice.
+"""
+
+# path segments that are IDs, replaced so the calls of an endpoint are grouped
+ID_SEGMENT = re.compile(r"^(?=.*\d)[\w.-]{8,}$|^\d+$")
+
+
+def get_endpoint(method: str, url: str) -> str:
+    """
+    Get the endpoint name of a request, with the IDs and the query removed.
+
+    :param method: The HTTP method.
+    :param url: The URL of the request.
+    :return: The endpoint, e.g. "GET api.example.com/v1/content/{id}".
+    """
+    parsed = urlparse(url)
+    path = "/".join(
+        "{id}" if ID_SEGMENT.match(segment) else segment
+        for segment in parsed.path.split("/")
+    )
+    return f"{method} {parsed.netloc}{path}"
+
+
+def percentile(values: List[float], ratio: float) -> float:
+    """
+    Nearest-rank percentile of sorted values.
+
+    :param values: The sorted values, not empty.
+    :param ratio: The percentile between 0 and 1.
+    :return: The percentile.
+    """
+    return values[min(len(values), max(1, ceil(ratio * len(values)))) - 1]
+
+
+class PerfStats:
+    """JSON lines file of request timings, shared by every process of the addon"""
+
+    def __init__(self, path: str, max_bytes: int = 1024 * 1024) -> None:
+        self.path = path
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+
+    def record(self, endpoint: str, status: int, size: int, elapsed: float) -> None:
+        """
+        Appends a timing record, trimming the file if needed.
+
+        :param endpoint: The endpoint of the request.
+        :param status: The HTTP status code.
+        :param size: The size of the response body in bytes, if known.
+        :param elapsed: The time until the response headers arrived in seconds.
+        :return: None
+        """
+        line = dumps(
+            {
+                "t": round(time(), 3),
+                "endpoint": endpoint,
+                "status": status,
+                "bytes": size,
+                "elapsed": round(elapsed, 4),
+            },
+            separators=(",", ":"),
+        )
+        # NOTE: short appends are atomic, so the processes don't need the lease here
+        with self.lock:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+            try:
+                too_big = os.path.getsize(self.path) > self.max_bytes
+            except OSError:
+                too_big = False
+        if too_big:
+            self._trim()
+
+    def _trim(self) -> None:
+        """
+        Keeps the newer half of the records.
+
+        :return: None
+        """
+        lease = FileLease(f"{self.path}.lock", timeout=0)
+        if not lease.acquire():
+            # someone else is trimming it right now
+            return
+        try:
+            with self.lock:
+                with open(self.path, "r", encoding="utf-8") as f:
+                    lines = f.readlines()
+                temp_path = f"{self.path}.{os.getpid()}.tmp"
+                with open(temp_path, "w", encoding="utf-8") as f:
+                    f.writelines(lines[len(lines) // 2 :])
+                os.replace(temp_path, self.path)
+        except OSError:
+            pass
+        finally:
+            lease.release()
+
+    def load(self) -> List[dict]:
+        """
+        Reads every record, skipping the broken (e.g. half written) lines.
+
+        :return: The records from the oldest to the newest.
+        """
+        records = []
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        records.append(loads(line))
+                    except ValueError:
+                        continue
+        except OSError:
+            pass
+        return records
+
+    def summarize(self) -> Dict[str, dict]:
+        """
+        Aggregates the records per endpoint.
+
+        :return: Dict of endpoint to count, p50, p95 (in seconds), error rate
+         and average size.
+        """
+        grouped = {}
+        for record in self.load():
+            grouped.setdefault(record.get("endpoint"), []).append(record)
+        summary = {}
+        for endpoint, records in grouped.items():
+            latencies = sorted(record["elapsed"] for record in records)
+            sizes = [record["bytes"] for record in records if record.get("bytes")]
+            summary[endpoint] = {
+                "count": len(records),
+                "p50": percentile(latencies, 0.5),
+                "p95": percentile(latencies, 0.95),
+                "error_rate": sum(1 for record in records if record["status"] >= 400)
+                / len(records),
+                "bytes": sum(sizes) / len(sizes) if sizes else None,
+            }
+        return summary
+
+    def clear(self) -> None:
+        """
+        Removes every record.
+
+        :return: None
+        """
+        with self.lock:
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+
+
+_perf_stats = None
+
+
+def get_perf_stats() -> PerfStats:
+    """
+    Get the timing log of the addon's profile.
+
+    :return: The timing log.
+    """
+    global _perf_stats
+    if not _perf_stats:
+        _perf_stats = PerfStats(get_profile_path("perfstats.jsonl"))
+    return _perf_stats
+
+
+def record_response(response: Response, *args, **kwargs) -> None:
+    """
+    Response hook of requests that records the timing of the response.
+
+    :param response: The response.
+    :return: None
+    """
+    if getattr(response, "brokered", False):
+        # already recorded by the service that sent it to the provider
+        return
+    if getattr(response.request, "preconnect", False):
+        # connection warm-ups, their statuses and timings mean nothing
+        return
+    if response._content_consumed and isinstance(response._content, bytes):
+        size = len(response._content)
+    else:
+        # NOTE: the body is only read after the hooks, this is the size on the wire
+        size = int(response.headers.get("Content-Length") or 0) or None
+    try:
+        get_perf_stats().record(
+            get_endpoint(response.request.method, response.request.url),
+            response.status_code,
+            size,
+            response.elapsed.total_seconds(),
+        )
+    except OSError:
+        # the stats are best-effort, never fail a request because of them
+        pass
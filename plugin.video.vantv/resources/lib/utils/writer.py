@@ -0,0 +1,82 @@
+from zlib import DEFLATED, MAX_WBITS, compressobj
+
+
+class BufferedWriter:
+    """
+    Accumulates written text in memory as UTF-8 and passes it on to the underlying
+     file in large blocks. Crossing the Kodi VFS boundary is expensive, especially on
+     network shares, so it's much cheaper to write a few big blocks instead of
+     many tiny ones.
+
+    If a compression level is given, the output is streamed through a gzip
+     compressor and the file receives gzip data instead of the plain UTF-8 text.
+
+    Can be used as a context manager, the remaining data is flushed on exit.
+    """
+
+    def __init__(
+        self, file, flush_threshold: int = 262144, compress_level: int = None
+    ) -> None:
+        """
+        :param file: The file-like object to write bytes to (e.g. xbmcvfs.File).
+        :param flush_threshold: Amount of buffered bytes that triggers a flush.
+        :param compress_level: gzip compression level (1-9), None disables compression.
+        """
+        self.file = file
+        self.flush_threshold = flush_threshold
+        self.parts = []
+        self.size = 0
+        self.compressor = None
+        if compress_level is not None:
+            # wbits offset of 16 makes zlib emit a gzip header and trailer
+            self.compressor = compressobj(compress_level, DEFLATED, MAX_WBITS | 16)
+
+    def write(self, data: str) -> None:
+        """
+        Buffers the data and flushes the buffer if it exceeds the threshold.
+
+        :param data: The text to write.
+        :return: None
+        """
+        # NOTE: the threshold is in bytes, accented characters take more than one
+        data = data.encode("utf-8")
+        self.parts.append(data)
+        self.size += len(data)
+        if self.size >= self.flush_threshold:
+            self.flush()
+
+    def flush(self) -> None:
+        """
+        Writes the buffered data to the underlying file in a single call.
+
+        :return: None
+        """
+        if not self.parts:
+            return
+        data = b"".join(self.parts)
+        self.parts = []
+        self.size = 0
+        if self.compressor:
+            data = self.compressor.compress(data)
+            if not data:
+                # compressor is still collecting input
+                return
+        self.file.write(data)
+
+    def close(self) -> None:
+        """
+        Flushes the buffer and finishes the gzip stream if compression is enabled.
+        Doesn't close the underlying file.
+
+        :return: None
+        """
+        self.flush()
+        if self.compressor:
+            self.file.write(self.compressor.flush())
+            self.compressor = None
+
+    def __enter__(self) -> "BufferedWriter":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
@@ -0,0 +1,221 @@
+from time import time
+from typing import Callable, List
+
+from requests import Session
+from resources.lib.utils.cache import ResponseCache
+from resources.lib.van import media_list
+
+"""
+Normalized channel catalogue shared by the channel listing and the exports.
+
+The raw service list is large and only a few fields are used from it, so
+ every service is reduced to a compact Channel record right after parsing.
+ The entitlement filtered result is kept in memory for a while, which means
+ consecutive consumers in the same process (e.g. the IPTV wizard exporting
+ the M3U and then the EPG) only hit the provider once.
+
+Optionally the provider responses are also kept in a persistent ResponseCache
+ with per-endpoint TTLs, so a fresh plugin process can render the channel list
+ without any provider round trip. Expired data is still served (up to MAX_STALE)
+ and the caller is notified, so it can have the data revalidated in the background.
+"""
+
+CATALOGUE_TTL = 600
+# per-endpoint TTLs of the persistent cache, the lineup rarely changes
+ENDPOINT_TTLS = {
+    "services": 6 * 3600,
+    "entitlements": 30 * 60,
+}
+MAX_STALE = 7 * 86400
+
+_cache = {}
+
+
+class Channel:
+    """Compact, normalized live channel record"""
+
+    __slots__ = (
+        "id",
+        "drm_id",
+        "url",
+        "name",
+        "genres",
+        "rating",
+        "is_adult",
+        "product_refs",
+    )
+
+    def __init__(self, service: dict) -> None:
+        editorial = service.get("editorial") or {}
+        technical = service.get("technical") or {}
+        ratings = editorial.get("Ratings") or []
+
+        self.id = editorial.get("id") or editorial.get("_id")
+        self.drm_id = technical.get("drmId")
+        self.url = technical.get("NetworkLocation")
+        self.name = editorial.get("longName")
+        self.genres = tuple(editorial.get("Categories") or ())
+        # first rating code from the list
+        self.rating = ratings[0].get("code") if ratings else None
+        # for some reason that's a string
+        self.is_adult = str(editorial.get("isAdult")).lower() == "true"
+        self.product_refs = tuple(technical.get("productRefs") or ())
+
+    def to_list(self) -> list:
+        """
+        Serialize the record into a compact list, see from_list.
+
+        :return: The values of the record in __slots__ order.
+        """
+        return [getattr(self, name) for name in self.__slots__]
+
+    @classmethod
+    def from_list(cls, values: list) -> "Channel":
+        """
+        Restore a record serialized with to_list.
+
+        :param values: The values of the record in __slots__ order.
+        :return: The channel record.
+        """
+        channel = cls.__new__(cls)
+        for name, value in zip(cls.__slots__, values):
+            setattr(channel, name, tuple(value) if isinstance(value, list) else value)
+        return channel
+
+    def is_entitled(self, entitlements: set) -> bool:
+        """
+        Check if the user is entitled to the channel.
+
+        :param entitlements: The set of subscribed product IDs.
+        :return: True if any of the channel's products is subscribed.
+        """
+        return any(product_ref in entitlements for product_ref in self.product_refs)
+
+    def logo(self, imageservice_base: str) -> str:
+        """
+        Get the logo URL of the channel.
+
+        NOTE: standard requests use much smaller 16:9 images
+        those look ugly within Kodi, so we use a higher resolution 1:1 image
+
+        :param imageservice_base: The image service base URL.
+        :return: The logo URL.
+        """
+        return f"{imageservice_base}/images/v1/image/channel/{self.id}/logo?aspect=1x1&height=256&imageFormat=webp&width=256"
+
+
+def get_subscribed_products(session: Session, api_base: str, access_token: str) -> set:
+    """
+    Get the set of products the current user is subscribed to.
+
+    :param session: The requests session to use.
+    :param api_base: The API base URL.
+    :param access_token: The access token to use for authentication.
+
+    :return: The set of subscribed product IDs.
+    """
+    entitlements = media_list.get_entitlements(session, api_base, access_token).get(
+        "resourceSet", []
+    )
+    return {
+        entitlement["productId"]
+        for entitlement in entitlements
+        if entitlement.get("productId") and entitlement.get("status") == "SUBSCRIBED"
+    }
+
+
+def _load_cached(
+    cache: ResponseCache,
+    key: str,
+    ttl: int,
+    loader: Callable,
+    refresh: bool,
+    on_stale: Callable,
+):
+    """
+    Load a value through the persistent cache with stale-while-revalidate semantics.
+
+    :param cache: The persistent cache, None to always call the loader.
+    :param key: The key of the entry.
+    :param ttl: Time in seconds the entry is considered fresh.
+    :param loader: Function that fetches the value from the provider.
+    :param refresh: Whether to skip the cache and fetch the value.
+    :param on_stale: Called with the key if an expired value is served.
+
+    :return: The value.
+    """
+    if cache and not refresh:
+        value, stored = cache.get(key)
+        age = time() - stored
+        if value is not None and age < MAX_STALE:
+            if age > ttl and on_stale:
+                on_stale(key)
+            return value
+    value = loader()
+    if cache:
+        cache.set(key, value)
+    return value
+
+
+def get_catalogue(
+    session: Session,
+    api_base: str,
+    access_token: str,
+    ttl: int = CATALOGUE_TTL,
+    cache: ResponseCache = None,
+    scope: str = "",
+    refresh: bool = False,
+    on_stale: Callable = None,
+) -> List[Channel]:
+    """
+    Get the list of channels the user is entitled to, in the provider's order.
+    The result is cached in memory for ttl seconds per access token and device type.
+    If a persistent cache is given, the provider responses are cached there as well.
+
+    :param session: The requests session to use.
+    :param api_base: The API base URL.
+    :param access_token: The access token to use for authentication.
+    :param ttl: Time in seconds the result is served from the memory cache.
+    :param cache: The persistent cache to use, if any.
+    :param scope: Distinguishes persistent entries of different accounts.
+    :param refresh: Whether to fetch everything from the provider.
+    :param on_stale: Called with the key if expired data is served from the persistent cache.
+
+    :return: The list of entitled channels.
+    """
+    device_type = session.device_properties["nagra_device_type"]
+    key = (api_base, access_token, device_type)
+    cached = _cache.get(key)
+    if cached and cached[0] > time() and not refresh:
+        return cached[1]
+
+    entitlements = set(
+        _load_cached(
+            cache,
+            f"entitlements:{api_base}:{scope}",
+            ENDPOINT_TTLS["entitlements"],
+            lambda: list(get_subscribed_products(session, api_base, access_token)),
+            refresh,
+            on_stale,
+        )
+    )
+    services = _load_cached(
+        cache,
+        f"services:{api_base}:{scope}:{device_type}",
+        ENDPOINT_TTLS["services"],
+        lambda: [
+            Channel(service).to_list()
+            for service in media_list.iter_channel_list(session, api_base, access_token)
+        ],
+        refresh,
+        on_stale,
+    )
+    channels = [
+        channel
+        for channel in map(Channel.from_list, services)
+        if channel.is_entitled(entitlements)
+    ]
+
+    _cache.clear()
+    _cache[key] = (time() + ttl, channels)
+    return channels
@@ -1,20 +1,21 @@
 from json import dumps
+from typing import Iterator
 
-from requests import Session
+from requests import Response, Session
+from resources.lib.utils.jsonstream import iter_response_array
 
 
-def get_channel_list(session: Session, api_base: str, access_token: str) -> dict:
+def _request_channel_list(
+    session: Session, api_base: str, access_token: str
+) -> Response:
     """
-    Get the list of live channels. For now without pagination, since the site uses a limit of 10000.
-    Which should be enough for plenty of channels in a single request.
-    params are also hardcoded for now, as they are hardcoded on the site as well
-     (subject to change in this codebase in the future).
+    Send the request for the list of live channels, the body is streamed.
 
     :param session: The requests session to use.
     :param api_base: The API base URL.
     :param access_token: The access token to use for authentication.
 
-    :return: The channel list in JSON format.
+    :return: The response object.
     """
     params = {
         "sort": '[["editorial.tvChannel",1]]',
@@ -26,14 +27,34 @@ def get_channel_list(session: Session, api_base: str, access_token: str) -> dict
         "Nagra-Device-Type": session.device_properties["nagra_device_type"],
         "Nagra-Target": session.device_properties["nagra_target"],
     }
-    response = session.get(
+    return session.get(
         f"{api_base}/metadata/delivery/GLOBAL/btv/services",
         params=params,
         headers=headers,
+        stream=True,
     )
-    response.raise_for_status()
-    json_data = response.json()
-    return json_data
+
+
+def iter_channel_list(
+    session: Session, api_base: str, access_token: str
+) -> Iterator[dict]:
+    """
+    Get the list of live channels. For now without pagination, since the site uses a limit of 10000.
+    Which should be enough for plenty of channels in a single request.
+    params are also hardcoded for now, as they are hardcoded on the site as well
+     (subject to change in this codebase in the future).
+    The response is parsed incrementally and the services are yielded one at a time.
+     Keeps the memory usage flat regardless of the size of the lineup.
+
+    :param session: The requests session to use.
+    :param api_base: The API base URL.
+    :param access_token: The access token to use for authentication.
+
+    :return: Iterator of the services in JSON format.
+    :raises HTTPError: If the request fails. Raised on call, not on iteration.
+    """
+    response = _request_channel_list(session, api_base, access_token)
+    return iter_response_array(response, "services")
 
 
 def get_entitlements(session: Session, api_base: str, access_token: str) -> dict:
@@ -60,7 +81,7 @@ def get_entitlements(session: Session, api_base: str, access_token: str) -> dict
     return json_data
 
 
-def get_epg(
+def _request_epg(
     session: Session,
     api_base: str,
     access_token: str,
@@ -68,9 +89,9 @@ def get_epg(
     from_time: str,
     to_time: str,
     fields: list,
-):
+) -> Response:
     """
-    Get the EPG for a list of channels.
+    Send the request for the EPG of a list of channels, the body is streamed.
 
     :param session: The requests session to use.
     :param api_base: The API base URL.
@@ -80,7 +101,7 @@ def get_epg(
     :param to_time: The end time for the EPG. Refer to docs for format.
     :param fields: The list of fields to include in the response.
 
-    :return: The EPG in JSON format.
+    :return: The response object.
     """
     headers = {
         "Authorization": f"Bearer {access_token}",
@@ -94,11 +115,40 @@ def get_epg(
     }
     if fields:
         params["fields"] = dumps(fields)
-    response = session.get(
+    return session.get(
         f"{api_base}/metadata/v1/epg",
         headers=headers,
         params=params,
+        stream=True,
     )
-    response.raise_for_status()
-    json_data = response.json()
-    return json_data
+
+
+def iter_epg(
+    session: Session,
+    api_base: str,
+    access_token: str,
+    channels: list,
+    from_time: str,
+    to_time: str,
+    fields: list,
+) -> Iterator[dict]:
+    """
+    Get the EPG for a list of channels. The response is parsed incrementally and
+     the results are yielded one channel at a time (channelId and its programmes).
+     Keeps the memory usage flat regardless of the amount of channels in the request.
+
+    :param session: The requests session to use.
+    :param api_base: The API base URL.
+    :param access_token: The access token to use for authentication.
+    :param channels: The list of channel IDs to get the EPG for.
+    :param from_time: The start time for the EPG. Refer to docs for format.
+    :param to_time: The end time for the EPG. Refer to docs for format.
+    :param fields: The list of fields to include in the response.
+
+    :return: Iterator of the per channel results in JSON format.
+    :raises HTTPError: If the request fails. Raised on call, not on iteration.
+    """
+    response = _request_epg(
+        session, api_base, access_token, channels, from_time, to_time, fields
+    )
+    return iter_response_array(response, "results")
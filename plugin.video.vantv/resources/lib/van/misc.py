@@ -1,8 +1,5 @@
 from base64 import b64encode
 
-from Cryptodome.Cipher import PKCS1_v1_5
-from Cryptodome.PublicKey import RSA
-
 
 def encrypt_password(password: str, public_key: str) -> str:
     """
@@ -12,6 +9,10 @@ def encrypt_password(password: str, public_key: str) -> str:
     :param public_key: The public key.
     :return: The encrypted password.
     """
+    # NOTE: Cryptodome is slow to import and only needed for sign-in
+    from Cryptodome.Cipher import PKCS1_v1_5
+    from Cryptodome.PublicKey import RSA
+
     rsa_key = RSA.importKey(public_key)
     cipher = PKCS1_v1_5.new(rsa_key)
     return b64encode(cipher.encrypt(password.encode("utf-8"))).decode("utf-8")
@@ -54,3 +54,27 @@ def setup_session(session: Session, api_base: str, content_token: str) -> dict:
     response.raise_for_status()
     json_data = response.json()
     return json_data
+
+
+def teardown_session(
+    session: Session, teardown_url: str, session_token: str, timeout: float = 5
+) -> bool:
+    """
+    Teardown the streaming session, which frees up the slot of the session
+     on the DRM provider's side.
+    A 4xx answer means the provider doesn't know the session anymore,
+     that's an ended session too.
+
+    :param session: The requests session to use.
+    :param teardown_url: The teardown URL of the DRM provider.
+    :param session_token: The current session token of the session.
+    :param timeout: The timeout of the request in seconds.
+
+    :return: False if the provider rejected the call with a 4xx answer.
+    """
+    headers = {"Nv-Authorizations": session_token}
+    response = session.post(teardown_url, headers=headers, json={}, timeout=timeout)
+    if 400 <= response.status_code < 500:
+        return False
+    response.raise_for_status()
+    return True
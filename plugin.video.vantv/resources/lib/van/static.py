@@ -2,8 +2,6 @@ from base64 import b64decode
 from functools import wraps
 
 import xbmcgui
-from Cryptodome.Cipher import AES
-from Cryptodome.Util.Padding import unpad
 
 _key = bytes.fromhex("6f6e65747670617373776f7264020202")
 _iv = bytes.fromhex("e81b70e7ea32d0d781e3294740a2f288")
@@ -131,6 +129,10 @@ def _decrypt_string(input: str) -> str:
     :param input: Encrypted string
     :return: Decrypted string
     """
+    # NOTE: Cryptodome is slow to import and the results are cached in properties
+    from Cryptodome.Cipher import AES
+    from Cryptodome.Util.Padding import unpad
+
     cipher = AES.new(_key, AES.MODE_CBC, _iv)
     return unpad(cipher.decrypt(b64decode(input)), 16, style="pkcs7").decode("utf-8")
 
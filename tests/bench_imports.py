@@ -0,0 +1,147 @@
+"""
+Import-time benchmark of the plugin's cold start, per action.
+
+Every click in Kodi starts a new interpreter that imports default.py, then the
+ modules the chosen action imports lazily. Each action is measured in its own
+ `python -X importtime` process with the stub Kodi modules loaded first, the
+ total is the cumulative time of everything imported after the stubs.
+
+Usage: python tests/bench_imports.py [--runs N] [--scale X] [--action NAME]
+
+Exits with a non-zero status if the median of an action is over its budget,
+ or if importing default.py alone pulls in one of the heavy modules. The
+ budgets are for a desktop, use --scale on slower devices.
+"""
+
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+from statistics import median
+
+TESTS_PATH = os.path.dirname(os.path.abspath(__file__))
+# modules that only the actions listing them may import
+HEAVY_MODULES = (
+    "bottle",
+    "Cryptodome",
+    "export_data",
+    "inputstreamhelper",
+    "iptv_wizard",
+    "licproxy_service",
+    "resources.lib.myvodka",
+)
+# NOTE: keep in sync with the lazy imports of the actions in default.py
+ACTIONS = {
+    # also channel_list, device_list, the settings and the about dialog
+    "main_menu": (),
+    "play_channel": ("inputstreamhelper",),
+    # the service isn't running, the playback starts its own license proxy
+    "play_channel_standalone": ("inputstreamhelper", "licproxy_service"),
+    # the first click without a token signs in
+    "sign_in": ("Cryptodome.Cipher.PKCS1_v1_5", "Cryptodome.PublicKey.RSA"),
+    "myvodka_device_list": (
+        "resources.lib.myvodka.login",
+        "resources.lib.myvodka.static",
+        "resources.lib.myvodka.vtv",
+    ),
+    "export_epg": ("export_data",),
+    "perf_stats": ("resources.lib.utils.perfstats",),
+    "iptv_wizard": ("iptv_wizard",),
+}
+# milliseconds, requests alone takes most of the main menu's budget
+BUDGETS = {
+    "main_menu": 200,
+    "play_channel": 250,
+    "play_channel_standalone": 300,
+    "sign_in": 250,
+    "myvodka_device_list": 200,
+    "export_epg": 300,
+    "perf_stats": 200,
+    "iptv_wizard": 200,
+}
+MARKER = "-- bench_imports --"
+IMPORT_LINE = re.compile(r"^import time:\s+\d+ \|\s+(\d+) \| (\s*)(\S+)$")
+
+CHILD = """
+import importlib, json, sys
+sys.path.insert(0, {tests!r})
+import kodistubs
+sys.stderr.write({marker!r} + "\\n")
+sys.stderr.flush()
+import default
+heavy = sorted(
+    name for name in sys.modules
+    if any(name == m or name.startswith(m + ".") for m in {heavy!r})
+)
+missing = []
+for name in {modules!r}:
+    try:
+        importlib.import_module(name)
+    except ImportError:
+        missing.append(name)
+print(json.dumps({{"heavy": heavy, "missing": missing}}))
+"""
+
+
+def measure(modules: tuple) -> tuple:
+    """
+    Imports default.py and the modules in a new interpreter.
+
+    :param modules: The modules the action imports lazily.
+    :return: The total import time in milliseconds, the heavy modules
+     default.py imported and the modules that aren't installed.
+    """
+    code = CHILD.format(
+        tests=TESTS_PATH, marker=MARKER, heavy=HEAVY_MODULES, modules=modules
+    )
+    process = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    lines = process.stderr.splitlines()
+    total = 0
+    for line in lines[lines.index(MARKER) + 1 :]:
+        match = IMPORT_LINE.match(line)
+        # nested imports are already part of their top level import
+        if match and not match.group(2):
+            total += int(match.group(1))
+    result = json.loads(process.stdout)
+    return total / 1000, result["heavy"], result["missing"]
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--scale", type=float, default=1, help="budget multiplier")
+    parser.add_argument("--action", choices=ACTIONS, action="append")
+    args = parser.parse_args()
+
+    failures = []
+    print(f"{'action':<25} {'median ms':>10} {'budget ms':>10}")
+    for action in args.action or ACTIONS:
+        timings = []
+        for _ in range(args.runs):
+            elapsed, heavy, missing = measure(ACTIONS[action])
+            timings.append(elapsed)
+        budget = BUDGETS[action] * args.scale
+        elapsed = median(timings)
+        note = f"  (not installed: {', '.join(missing)})" if missing else ""
+        print(f"{action:<25} {elapsed:>10.1f} {budget:>10.0f}{note}")
+        if elapsed > budget:
+            failures.append(f"{action} took {elapsed:.1f} ms, budget {budget:.0f} ms")
+        if heavy:
+            failures.append(f"default.py imports {', '.join(heavy)}")
+
+    for failure in sorted(set(failures)):
+        print(f"FAIL: {failure}")
+    if not failures:
+        print("OK")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
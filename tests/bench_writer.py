@@ -0,0 +1,126 @@
+"""
+Benchmark of the XMLTV output: writing every element straight to the file
+ versus collecting it in BufferedWriter, against a local temporary file and
+ against a fake VFS file that pays a fixed latency on every write call, like
+ xbmcvfs.File on an SMB/NFS share.
+
+Usage: python tests/bench_writer.py [--programmes N] [--latency MS]
+
+Exits with a non-zero status if the buffered writer isn't faster on the slow
+ VFS or if the outputs differ.
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import kodistubs  # noqa: F401
+from resources.lib.utils.writer import BufferedWriter
+
+
+class LocalFile:
+    """Local file with the write interface of xbmcvfs.File"""
+
+    def __init__(self, path: str) -> None:
+        self.file = open(path, "wb")
+        self.calls = 0
+
+    def write(self, data) -> bool:
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        self.calls += 1
+        self.file.write(data)
+        return True
+
+    def close(self) -> None:
+        self.file.close()
+
+
+class SlowVFSFile(LocalFile):
+    """Local file where every write call costs a round trip"""
+
+    def __init__(self, path: str, latency: float) -> None:
+        super().__init__(path)
+        self.latency = latency
+
+    def write(self, data) -> bool:
+        time.sleep(self.latency)
+        return super().write(data)
+
+
+def programme_elements(count: int):
+    """Yields the writes of an EPG export, with accented Hungarian text"""
+    for i in range(count):
+        yield (
+            f'<programme start="20240101{i % 24:02d}0000 +0000" '
+            f'stop="20240101{(i + 1) % 24:02d}0000 +0000" channel="ch{i % 40}"'
+        )
+        yield f' catchup-id="plugin://plugin.video.vantv/?action=catchup&amp;id={i}"'
+        yield ">"
+        yield f'<title lang="hu">Híradó – esti kiadás {i}</title>'
+        yield (
+            '<desc lang="hu">Árvíztűrő tükörfúrógép: a nap legfontosabb '
+            "hírei, időjárás és sporteredmények összefoglalója.</desc>"
+        )
+        yield f'<icon src="https://img.example/images/v1/image/movie/{i}/banner"/>'
+        yield '<episode-num system="xmltv_ns">0.11.</episode-num>'
+        yield "<country>HU</country>"
+        yield '<sub-title lang="hu">Első rész</sub-title>'
+        yield "</programme>"
+
+
+def run(file, count: int, buffered: bool, threshold: int) -> float:
+    start = time.perf_counter()
+    if buffered:
+        with BufferedWriter(file, threshold) as writer:
+            for element in programme_elements(count):
+                writer.write(element)
+    else:
+        for element in programme_elements(count):
+            file.write(element)
+    file.close()
+    return time.perf_counter() - start
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--programmes", type=int, default=5000)
+    parser.add_argument("--latency", type=float, default=0.2, help="milliseconds")
+    parser.add_argument("--buffer", type=int, default=256, help="KiB")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix="vantv-bench-")
+    results = {}
+    outputs = {}
+    for target in ("local", "slow VFS"):
+        for buffered in (False, True):
+            path = os.path.join(directory, f"{target}-{buffered}.xml")
+            if target == "local":
+                file = LocalFile(path)
+            else:
+                file = SlowVFSFile(path, args.latency / 1000)
+            elapsed = run(file, args.programmes, buffered, args.buffer * 1024)
+            results[target, buffered] = (elapsed, file.calls)
+            with open(path, "rb") as f:
+                outputs[target, buffered] = f.read()
+
+    size = len(outputs["local", False])
+    print(f"{args.programmes} programmes, {size / 1048576:.1f} MiB of XML")
+    print(f"{'target':<10} {'writer':<10} {'seconds':>9} {'writes':>9}")
+    for (target, buffered), (elapsed, calls) in results.items():
+        writer = "buffered" if buffered else "direct"
+        print(f"{target:<10} {writer:<10} {elapsed:>9.3f} {calls:>9}")
+
+    if len(set(outputs.values())) != 1:
+        print("FAIL: the outputs differ")
+        return 1
+    if results["slow VFS", True][0] >= results["slow VFS", False][0]:
+        print("FAIL: buffering didn't speed up the slow VFS")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
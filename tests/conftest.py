@@ -0,0 +1,2 @@
+# the Kodi modules must be in place before anything from the addon is imported
+import kodistubs  # noqa: F401
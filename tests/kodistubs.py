@@ -0,0 +1,234 @@
+"""
+Minimal stand-ins for the Kodi Python API, so parts of the addon can be
+ imported and exercised outside of Kodi by the tests and the benchmarks.
+
+Only what the addon touches is implemented. Settings start from the defaults
+ in resources/settings.xml, window properties are shared by every Window like
+ the properties of the home window in Kodi, and special://profile points to
+ a temporary directory.
+
+Import this module before anything from the addon.
+"""
+
+import os
+import sys
+import tempfile
+import threading
+import time
+import types
+import xml.etree.ElementTree as ET
+
+ADDON_ID = "plugin.video.vantv"
+ADDON_PATH = os.path.join(os.path.dirname(os.path.dirname(__file__)), ADDON_ID)
+PROFILE_PATH = tempfile.mkdtemp(prefix="vantv-profile-")
+
+# settings shared by every Addon instance, like in Kodi
+settings = {}
+# properties shared by every Window
+window_properties = {}
+# (level, message) pairs of xbmc.log
+log_records = []
+
+
+def _load_default_settings() -> None:
+    tree = ET.parse(os.path.join(ADDON_PATH, "resources", "settings.xml"))
+    for setting in tree.iter("setting"):
+        default = setting.find("default")
+        settings[setting.get("id")] = default.text or "" if default is not None else ""
+
+
+def _module(name: str) -> types.ModuleType:
+    module = types.ModuleType(name)
+    sys.modules[name] = module
+    return module
+
+
+# xbmc
+xbmc = _module("xbmc")
+xbmc.LOGDEBUG, xbmc.LOGINFO, xbmc.LOGWARNING, xbmc.LOGERROR = 0, 1, 2, 3
+
+
+def _log(message: str, level: int = 0) -> None:
+    log_records.append((level, message))
+
+
+xbmc.log = _log
+xbmc.executebuiltin = lambda *args, **kwargs: None
+xbmc.executeJSONRPC = lambda *args, **kwargs: "{}"
+# a desktop Kodi 21, info labels the addon doesn't ask for are empty
+info_labels = {"System.BuildVersion": "21.0 (21.0.0) Git:stub"}
+xbmc.getInfoLabel = lambda label: info_labels.get(label, "")
+xbmc.sleep = lambda milliseconds: time.sleep(milliseconds / 1000)
+
+
+class Monitor:
+    def __init__(self, *args, **kwargs) -> None:
+        self._abort = threading.Event()
+
+    def abortRequested(self) -> bool:
+        return self._abort.is_set()
+
+    def waitForAbort(self, timeout: float = None) -> bool:
+        return self._abort.wait(timeout)
+
+
+class Player:
+    def __init__(self, *args, **kwargs) -> None:
+        pass
+
+    def isPlaying(self) -> bool:
+        return False
+
+    def getPlayingFile(self) -> str:
+        return ""
+
+
+xbmc.Monitor = Monitor
+xbmc.Player = Player
+
+# xbmcaddon
+xbmcaddon = _module("xbmcaddon")
+
+
+class Addon:
+    def __init__(self, *args, **kwargs) -> None:
+        pass
+
+    def getAddonInfo(self, key: str) -> str:
+        return {
+            "id": ADDON_ID,
+            "name": "VanTV",
+            "path": ADDON_PATH,
+            "profile": PROFILE_PATH,
+            "version": "0.0.0",
+        }.get(key, "")
+
+    def getLocalizedString(self, string_id: int) -> str:
+        return str(string_id)
+
+    def getSetting(self, key: str) -> str:
+        return settings.get(key, "")
+
+    def getSettingBool(self, key: str) -> bool:
+        return settings.get(key) == "true"
+
+    def getSettingInt(self, key: str) -> int:
+        try:
+            return int(settings.get(key) or 0)
+        except ValueError:
+            return 0
+
+    def setSetting(self, key: str, value: str) -> None:
+        settings[key] = str(value)
+
+    def setSettingBool(self, key: str, value: bool) -> None:
+        settings[key] = "true" if value else "false"
+
+    def setSettingInt(self, key: str, value: int) -> None:
+        settings[key] = str(value)
+
+    def openSettings(self) -> None:
+        pass
+
+
+xbmcaddon.Addon = Addon
+
+# xbmcgui
+xbmcgui = _module("xbmcgui")
+xbmcgui.NOTIFICATION_INFO = "info"
+xbmcgui.NOTIFICATION_WARNING = "warning"
+xbmcgui.NOTIFICATION_ERROR = "error"
+xbmcgui.INPUT_TYPE_TEXT = 0
+
+
+class Window:
+    def __init__(self, window_id: int = 0) -> None:
+        pass
+
+    def getProperty(self, key: str) -> str:
+        return window_properties.get(key, "")
+
+    def setProperty(self, key: str, value: str) -> None:
+        window_properties[key] = value
+
+    def clearProperty(self, key: str) -> None:
+        window_properties.pop(key, None)
+
+
+class Dialog:
+    def __getattr__(self, name: str):
+        # every dialog is dismissed right away
+        return lambda *args, **kwargs: None
+
+
+class DialogProgress(Dialog):
+    def iscanceled(self) -> bool:
+        return False
+
+
+class ListItem:
+    def __init__(self, label: str = "", path: str = "", **kwargs) -> None:
+        self.label = label
+        self.path = path
+
+    def __getattr__(self, name: str):
+        return lambda *args, **kwargs: None
+
+
+xbmcgui.Window = Window
+xbmcgui.Dialog = Dialog
+xbmcgui.DialogProgress = DialogProgress
+xbmcgui.ListItem = ListItem
+
+# xbmcvfs
+xbmcvfs = _module("xbmcvfs")
+
+
+def translatePath(path: str) -> str:
+    prefix = f"special://profile/addon_data/{ADDON_ID}"
+    if path.startswith(prefix):
+        return PROFILE_PATH + path[len(prefix) :]
+    return path
+
+
+class File:
+    def __init__(self, path: str, mode: str = "r") -> None:
+        self.file = open(translatePath(path), "wb" if "w" in mode else "rb")
+
+    def write(self, data) -> bool:
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        self.file.write(data)
+        return True
+
+    def read(self, size: int = -1) -> str:
+        return self.file.read(size).decode("utf-8")
+
+    def close(self) -> None:
+        self.file.close()
+
+    def __enter__(self) -> "File":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+
+xbmcvfs.translatePath = translatePath
+xbmcvfs.File = File
+xbmcvfs.exists = lambda path: os.path.exists(translatePath(path))
+xbmcvfs.mkdirs = lambda path: os.makedirs(translatePath(path), exist_ok=True) or True
+xbmcvfs.rename = lambda source, target: os.replace(
+    translatePath(source), translatePath(target)
+)
+
+# xbmcplugin
+xbmcplugin = _module("xbmcplugin")
+xbmcplugin.addDirectoryItem = lambda *args, **kwargs: True
+xbmcplugin.endOfDirectory = lambda *args, **kwargs: None
+xbmcplugin.setContent = lambda *args, **kwargs: None
+xbmcplugin.setResolvedUrl = lambda *args, **kwargs: None
+
+_load_default_settings()
+if ADDON_PATH not in sys.path:
+    sys.path.insert(0, ADDON_PATH)
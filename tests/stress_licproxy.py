@@ -0,0 +1,195 @@
+"""
+Concurrency stress test of the license proxy against a local stub license server.
+
+The stub rotates the session token on every renewal and records every request
+ that arrives with an outdated token, or while another renewal of the same
+ session is still in flight. The proxy is started with start_server, one
+ playback session is registered on it and then:
+
+1. concurrent initial license requests are sent, they must not wait for
+   each other;
+2. concurrent renewals and retries are fired from many threads, each of them
+   must reach the upstream with the latest token and be counted exactly once.
+
+Usage: python tests/stress_licproxy.py [--threads N] [--renewals M] [--latency MS]
+
+Exits with a non-zero status if any of the checks fail.
+"""
+
+import argparse
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from json import dumps
+
+import kodistubs  # noqa: F401
+import requests
+from licproxy_service import start_server
+from resources.lib.utils.ledger import get_session_ledger
+
+
+class StubLicenseServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, latency: float) -> None:
+        super().__init__(("127.0.0.1", 0), StubLicenseHandler)
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.token = "token-0"
+        self.licenses = 0
+        self.renewals = 0
+        self.in_flight = 0
+        self.errors = []
+
+
+class StubLicenseHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # headers and body are written separately, don't wait for delayed ACKs
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args, **kwargs) -> None:
+        pass
+
+    def do_POST(self) -> None:
+        server = self.server
+        self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        if self.path.startswith("/license"):
+            with server.lock:
+                server.licenses += 1
+            time.sleep(server.latency)
+            self.reply({"license": ["initial"]})
+        elif self.path.startswith("/renewal"):
+            token = self.headers.get("Nv-Authorizations")
+            with server.lock:
+                server.in_flight += 1
+                if server.in_flight > 1:
+                    server.errors.append("concurrent renewals reached the upstream")
+                if token != server.token:
+                    server.errors.append(f"stale token {token}, latest {server.token}")
+            # widen the window a racing renewal would need
+            time.sleep(server.latency)
+            with server.lock:
+                server.renewals += 1
+                server.token = f"token-{server.renewals}"
+                new_token = server.token
+                server.in_flight -= 1
+            self.reply({"license": ["renewed"], "sessionToken": new_token})
+        elif self.path.startswith("/teardown"):
+            self.reply({})
+        else:
+            self.send_error(404)
+
+    def reply(self, data: dict) -> None:
+        body = dumps(data).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--renewals", type=int, default=10, help="per thread")
+    parser.add_argument("--initial", type=int, default=8)
+    parser.add_argument("--latency", type=float, default=20, help="milliseconds")
+    args = parser.parse_args()
+
+    upstream = StubLicenseServer(args.latency / 1000)
+    threading.Thread(target=upstream.serve_forever, daemon=True).start()
+    base = f"http://127.0.0.1:{upstream.server_port}"
+
+    web_thread = start_server(kodistubs.Addon())
+    proxy = f"http://127.0.0.1:{web_thread.port}"
+    app_config = web_thread.httpd.app.config
+    # the stub stands in for the license server
+    app_config["broker_hosts"].add(f"127.0.0.1:{upstream.server_port}")
+    get_session_ledger().add("token-0")
+    session_id = requests.post(
+        f"{proxy}/sessions",
+        json={
+            "license_url": f"{base}/license",
+            "renewal_url": f"{base}/renewal",
+            "session_token": "token-0",
+            "teardown_url": f"{base}/teardown",
+        },
+        timeout=5,
+    ).json()["id"]
+    license_session = app_config["sessions"][session_id]
+    license_url = f"{proxy}/wv/{session_id}/license"
+    failures = []
+
+    def send(kind: str) -> int:
+        # the challenge is opaque to the proxy outside of Android
+        return requests.post(
+            license_url, data=b'{"challenge":"' + kind.encode() + b'"}', timeout=60
+        ).status_code
+
+    # 1. initial license requests run in parallel
+    start = time.perf_counter()
+    with ThreadPoolExecutor(args.initial) as executor:
+        statuses = list(executor.map(send, ["license"] * args.initial))
+    initial_elapsed = time.perf_counter() - start
+    if statuses.count(200) != args.initial:
+        failures.append(f"initial license statuses: {statuses}")
+    if initial_elapsed >= args.initial * upstream.latency * 0.75:
+        failures.append(
+            f"initial license requests were serialized ({initial_elapsed:.3f}s)"
+        )
+
+    # 2. renewals and ISA's retries, fired together from every thread
+    total = args.threads * args.renewals
+    start = time.perf_counter()
+    with ThreadPoolExecutor(args.threads) as executor:
+        statuses = list(
+            executor.map(send, ["renewal" if i % 2 else "retry" for i in range(total)])
+        )
+    renewal_elapsed = time.perf_counter() - start
+
+    ledger_token = get_session_ledger()._load().get("token-0", {}).get("token")
+    renewals_total = sum(
+        value
+        for (name, _), value in app_config["metrics"].counters.items()
+        if name == "renewals_total"
+    )
+    if statuses.count(200) != total:
+        failures.append(f"{total - statuses.count(200)} renewals failed")
+    failures.extend(upstream.errors)
+    for name, count in (
+        ("upstream renewals", upstream.renewals),
+        ("session renewals", license_session.renewals),
+        ("renewals_total metric", renewals_total),
+    ):
+        if count != total:
+            failures.append(f"{name}: {count}, expected {total}")
+    if license_session.session_token != upstream.token:
+        failures.append(
+            f"proxy token {license_session.session_token}, latest {upstream.token}"
+        )
+    if ledger_token != upstream.token:
+        failures.append(f"ledger token {ledger_token}, latest {upstream.token}")
+
+    web_thread.stop()
+    web_thread.join(10)
+    upstream.shutdown()
+
+    print(
+        f"{args.initial} initial licenses in {initial_elapsed:.3f}s "
+        f"(upstream latency {args.latency:.0f} ms each)"
+    )
+    print(
+        f"{total} renewals from {args.threads} threads in {renewal_elapsed:.3f}s, "
+        f"{total / renewal_elapsed:.1f} renewals/s"
+    )
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    if not failures:
+        print("OK")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,32 @@
+import threading
+
+import export_data
+from resources.lib.utils.epgcache import EPGCache
+
+
+def test_cancelled_window_stops_streaming(tmp_path, monkeypatch):
+    is_killed = threading.Event()
+    read = []
+    closed = threading.Event()
+
+    def fetch_epg_window(addon, session, channels, from_time, to_time):
+        try:
+            for channel_id in channels:
+                read.append(channel_id)
+                if channel_id == "b":
+                    # cancelled while the response is still streaming
+                    is_killed.set()
+                yield {"channelId": channel_id, "programmes": [{"id": channel_id}]}
+        finally:
+            closed.set()
+
+    monkeypatch.setattr(export_data, "_fetch_epg_window", fetch_epg_window)
+    cache = EPGCache(str(tmp_path))
+    result = export_data._load_epg_window(
+        None, None, cache, ["a", "b", "c", "d"], 19000, True, is_killed
+    )
+    assert result == {}
+    assert read == ["a", "b"]
+    assert closed.is_set()
+    assert cache.load("a", 19000) == [{"id": "a"}]
+    assert not cache.stored_at("c", 19000)
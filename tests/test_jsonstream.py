@@ -0,0 +1,91 @@
+import json
+import random
+
+import pytest
+from resources.lib.utils.jsonstream import iter_array
+
+DOCUMENT = {
+    "total": 12.5,
+    "offset": -3,
+    "ratio": 1e-5,
+    "big": 12345678901234567890,
+    "name": "Duna Médiaszolgáltató – ő ű 📺",
+    "flags": [True, False, None],
+    "services": [
+        1.5,
+        -0.25,
+        2e10,
+        3.75e-3,
+        0,
+        {"id": "m1", "title": "Híradó", "period": {"start": 1700000000, "end": 1.5}},
+        ["nested", [1, 2.5, {"x": -1e3}]],
+        'szöveg "idézőjel" \\ vége',
+        None,
+        True,
+    ],
+    "after": {"skipped": [1, 2, 3]},
+}
+
+
+def chunked(data: bytes, boundaries: list) -> list:
+    boundaries = [0] + sorted(boundaries) + [len(data)]
+    return [data[start:end] for start, end in zip(boundaries, boundaries[1:])]
+
+
+@pytest.mark.parametrize(
+    "chunks",
+    [
+        [b'{"services":[1.', b"5]}"],
+        [b'{"services":[1e', b"5]}"],
+        [b'{"services":[1', b".5e", b"-", b"2]}"],
+        [b'{"services":[-', b"1]}"],
+        [b'{"total": 12', b'.5, "services":[2]}'],
+        [b'{"total": 12.', b'5, "services":[2]}'],
+    ],
+)
+def test_number_split_at_chunk_boundary(chunks):
+    expected = json.loads(b"".join(chunks))["services"]
+    assert list(iter_array(iter(chunks), "services")) == expected
+
+
+def test_number_at_end_of_stream():
+    assert list(iter_array(iter([b'{"services":[1', b"]}"]), "services")) == [1]
+    assert list(iter_array(iter([b'{"a":1', b"}"]), "services")) == []
+
+
+@pytest.mark.parametrize("seed", range(200))
+def test_random_chunk_boundaries(seed):
+    rng = random.Random(seed)
+    data = json.dumps(DOCUMENT, ensure_ascii=False).encode("utf-8")
+    if seed % 2:
+        data = json.dumps(DOCUMENT, ensure_ascii=False, indent=2).encode("utf-8")
+    boundaries = rng.sample(range(1, len(data)), rng.randint(1, len(data) // 2))
+    assert list(iter_array(iter(chunked(data, boundaries)), "services")) == (
+        DOCUMENT["services"]
+    )
+
+
+@pytest.mark.parametrize("key", ["flags", "services", "missing"])
+def test_every_byte_a_chunk(key):
+    data = json.dumps(DOCUMENT, ensure_ascii=False).encode("utf-8")
+    chunks = [data[i : i + 1] for i in range(len(data))]
+    assert list(iter_array(iter(chunks), key)) == DOCUMENT.get(key, [])
+
+
+def test_empty_array_and_object():
+    assert list(iter_array(iter([b'{"services":[]}']), "services")) == []
+    assert list(iter_array(iter([b"{}"]), "services")) == []
+
+
+@pytest.mark.parametrize(
+    "chunks",
+    [
+        [b'{"services":[1.x]}'],
+        [b'{"services":[1', b",,2]}"],
+        [b'{"services":[1'],
+        [b"[1, 2]"],
+    ],
+)
+def test_invalid_json(chunks):
+    with pytest.raises(ValueError):
+        list(iter_array(iter(chunks), "services"))
@@ -0,0 +1,17 @@
+import pytest
+from resources.lib.utils.licproxy import _split_timeout, parse_broker_timeout
+
+
+@pytest.mark.parametrize(
+    "timeout, expected",
+    [((5, 30), (5, 30)), (10, (10, 10)), (None, (60, 60)), ((5, None), (5, 60))],
+)
+def test_timeout_round_trip(timeout, expected):
+    connect_timeout, read_timeout = _split_timeout(timeout)
+    assert (connect_timeout, read_timeout) == expected
+    assert parse_broker_timeout(f"{connect_timeout},{read_timeout}") == expected
+
+
+@pytest.mark.parametrize("value", [None, "", "30", "a,b", "0,30", "5,-1"])
+def test_invalid_timeouts_use_the_default(value):
+    assert parse_broker_timeout(value) is None
@@ -0,0 +1,82 @@
+import threading
+import time
+
+import kodistubs
+import pytest
+import requests
+from licproxy_service import LicenseSession, start_server
+from resources.lib.van import static
+
+
+@pytest.fixture
+def proxy():
+    web_thread = start_server(kodistubs.Addon())
+    yield web_thread
+    web_thread.stop()
+    web_thread.join(10)
+
+
+def session_parameters(base: str) -> dict:
+    return {
+        "license_url": f"{base}/ssm/v1/widevine-license",
+        "renewal_url": f"{base}/ssm/v1/renewal-license-wv",
+        "session_token": "token",
+        "teardown_url": f"{base}/ssm/v1/sessions/teardown",
+    }
+
+
+def test_registers_provider_urls(proxy):
+    data = session_parameters(static.get_license_server_base())
+    response = requests.post(
+        f"http://127.0.0.1:{proxy.port}/sessions", json=data, timeout=5
+    )
+    assert response.status_code == 200
+    sessions = proxy.httpd.app.config["sessions"]
+    assert response.json()["id"] in sessions
+    # don't send the teardown to the provider when the server stops
+    sessions.clear()
+
+
+@pytest.mark.parametrize("key", ["license_url", "renewal_url", "teardown_url"])
+def test_rejects_other_hosts(proxy, key):
+    data = session_parameters(static.get_license_server_base())
+    data[key] = "http://192.168.1.10:8080/admin"
+    response = requests.post(
+        f"http://127.0.0.1:{proxy.port}/sessions", json=data, timeout=5
+    )
+    assert response.status_code == 400
+    assert not proxy.httpd.app.config["sessions"]
+
+
+def test_concurrent_stops(proxy):
+    # a closed port, the teardown calls fail right away
+    teardown_url = "http://127.0.0.1:9/ssm/v1/sessions/teardown"
+    sessions = proxy.httpd.app.config["sessions"]
+    for i in range(50):
+        sessions[str(i)] = LicenseSession("", "", f"token-{i}", teardown_url)
+    submitted = []
+
+    def submit(license_session: LicenseSession) -> None:
+        # widen the window between checking and draining the sessions
+        time.sleep(0.001)
+        submitted.append(license_session)
+
+    proxy.httpd.app.config["teardown_worker"].submit = submit
+    errors = []
+
+    def stop() -> None:
+        try:
+            proxy.stop()
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=stop) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert not errors
+    assert not sessions
+    assert sorted(s.session_token for s in submitted) == sorted(
+        f"token-{i}" for i in range(50)
+    )
@@ -0,0 +1,41 @@
+import threading
+from datetime import timedelta
+
+import requests
+from resources.lib.utils import preconnect
+from resources.lib.utils.perfstats import PerfStats, record_response
+
+
+def make_response(method: str, url: str, status: int) -> requests.Response:
+    response = requests.Response()
+    response.status_code = status
+    response.request = requests.Request(method, url).prepare()
+    response.elapsed = timedelta(milliseconds=120)
+    return response
+
+
+def test_skips_preconnects(tmp_path, monkeypatch):
+    stats = PerfStats(str(tmp_path / "perfstats.jsonl"))
+    monkeypatch.setattr("resources.lib.utils.perfstats.get_perf_stats", lambda: stats)
+    warm_up = make_response("HEAD", "https://api.example/", 405)
+    warm_up.request.preconnect = True
+    record_response(warm_up)
+    record_response(make_response("GET", "https://api.example/v1/items/12345", 200))
+    assert list(stats.summarize()) == ["GET api.example/v1/items/{id}"]
+
+
+def test_preconnect_marks_requests():
+    sent = []
+    done = threading.Event()
+
+    class RecordingSession(requests.Session):
+        def send(self, request, **kwargs):
+            sent.append(request)
+            done.set()
+            return requests.Response()
+
+    preconnect(RecordingSession(), ["https://api.example/v1/items?page=2"])
+    assert done.wait(5)
+    assert sent[0].method == "HEAD"
+    assert sent[0].url == "https://api.example/"
+    assert sent[0].preconnect
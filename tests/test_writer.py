@@ -0,0 +1,32 @@
+import gzip
+
+from resources.lib.utils.writer import BufferedWriter
+
+
+class RecordingFile:
+    def __init__(self) -> None:
+        self.blocks = []
+
+    def write(self, data: bytes) -> bool:
+        self.blocks.append(data)
+        return True
+
+
+def test_flushes_by_encoded_size():
+    file = RecordingFile()
+    # 10 characters, 20 bytes in UTF-8
+    element = "őűáéíóöüúŐ"
+    with BufferedWriter(file, 100) as writer:
+        for _ in range(20):
+            writer.write(element)
+    assert b"".join(file.blocks) == (element * 20).encode("utf-8")
+    assert [len(block) for block in file.blocks] == [100, 100, 100, 100]
+
+
+def test_compressed_output():
+    file = RecordingFile()
+    text = "<tv>" + "<title>Híradó</title>" * 1000 + "</tv>"
+    with BufferedWriter(file, 64, 6) as writer:
+        for i in range(0, len(text), 7):
+            writer.write(text[i : i + 7])
+    assert gzip.decompress(b"".join(file.blocks)).decode("utf-8") == text